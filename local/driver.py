@@ -0,0 +1,77 @@
+# in-process local driver for river, used instead of scripts next to it
+#
+# files are copied without spawning processes, by the cheapest way filesystem supports:
+# reflink (copy-on-write clone, same filesystem on btrfs, xfs and alike), then copy_file_range, then sendfile,
+# then buffered copy. Hardlinks are never used: river modifies downloaded index in place and frees parts of
+# uploaded tomes, which would change the backup through a shared inode.
+import errno
+import fcntl
+import os
+import shutil
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int)
+copy_chunk = 1024 * 1024 * 1024
+
+
+def reflink(fi, fo):
+    try:
+        fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+        return True
+    except OSError:
+        return False
+
+
+# copies rest of fi to fo by `copy` (copy_file_range or sendfile), False if it is not supported for these files
+def kernel_copy(fi, fo, copy):
+    copied = 0
+    while True:
+        try:
+            n = copy(fi, fo)
+        except OSError as e:
+            if copied == 0 and e.errno in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF]:
+                return False
+            raise
+        if n == 0:
+            return True
+        copied += n
+
+
+def copy_file_range(fi, fo):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    return os.copy_file_range(fi.fileno(), fo.fileno(), copy_chunk)
+
+
+def sendfile(fi, fo):
+    n = os.sendfile(fo.fileno(), fi.fileno(), None, copy_chunk)
+    fo.seek(0, os.SEEK_END)  # sendfile does not move position of fo object
+    return n
+
+
+# writes into existing dst like `cp`, so files already open by river see new content
+def copy(src, dst):
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    with open(src, "rb") as fi, open(dst, "wb") as fo:
+        if not reflink(fi, fo) and not kernel_copy(fi, fo, copy_file_range) and not kernel_copy(fi, fo, sendfile):
+            shutil.copyfileobj(fi, fo, 1024 * 1024)
+
+
+def upload(src, dst):
+    copy(src, dst)
+
+
+def download(src, dst):
+    copy(src, dst)
+
+
+def delete(path):
+    if path in ["", "/", "."]:
+        return
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def stat(path):
+    return [os.path.getsize(path), None]
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+#
+# river-bench.py proc [count]
+#   Proc.run overhead of current exit waiter against legacy polling
+#
+# river-bench.py backup [--latency <ms>] [--scale <n>] [--save <baseline.json>] [--compare <baseline.json>]
+#   backup, incremental, restore and verify of synthetic trees with local driver and with
+#   fake-latency driver, which sleeps <ms> before every call (default 20)
+#   reports per phase: wall time, time in zpaq, orchestration time (wall minus zpaq), state load and save time,
+#   processes spawned by river, bytes uploaded and downloaded and throughput of source tree
+#   --save writes results to json, --compare prints them against saved baseline and exits with 1
+#   if orchestration time (by more than 50ms) or spawn count grew by more than 25%
+#
+# Like river-test.py, needs zpaq binary next to river.py
+import river
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# emulates Proc.run wait loop before pidfd support: fixed 50ms sleep between polls
+class LegacyWaiter:
+    def __init__(self, procs):
+        pass
+
+    def remove(self, p):
+        pass
+
+    def wait(self):
+        time.sleep(0.05)
+
+    def close(self):
+        pass
+
+
+def measure(make_proc, count):
+    start = time.time()
+    for _ in range(count):
+        make_proc().run(river.stdout)
+    return (time.time() - start) / count
+
+
+def bench_proc(count):
+    cases = [
+        ["true", lambda: river.Proc(["true"])],
+        ["pipe", lambda: river.Proc.string_source("hello").pipe(river.Proc(["cat"]))],
+        ["par", lambda: river.Proc(["true"]).par(river.Proc(["true"]))],
+    ]
+
+    waiter = river.ExitWaiter
+    print("Proc.run overhead per operation, ms")
+    print("case\tlegacy\tcurrent")
+    for name, make_proc in cases:
+        river.ExitWaiter = LegacyWaiter
+        legacy = measure(make_proc, count)
+        river.ExitWaiter = waiter
+        current = measure(make_proc, count)
+        print(name + "\t" + "%.2f" % (legacy * 1000) + "\t" + "%.2f" % (current * 1000))
+
+
+# counters of current phase
+class Stats:
+    def __init__(self):
+        self.spawns = 0
+        self.zpaq = 0.0
+        self.state = 0.0
+
+
+stats = Stats()
+
+
+# counts processes started by river and time spent in zpaq
+class CountingPopen(subprocess.Popen):
+    def __init__(self, args, *a, **kw):
+        super().__init__(args, *a, **kw)
+        stats.spawns += 1
+        self.bench_start = time.time()
+        self.bench_zpaq = os.path.basename(str(args[0])) == "zpaq"
+        self.bench_counted = False
+
+    # set by Popen.poll and wait, and directly by asyncio child watcher for processes of Proc.run_async
+    @property
+    def returncode(self):
+        return self.__dict__.get("bench_returncode")
+
+    @returncode.setter
+    def returncode(self, code):
+        self.__dict__["bench_returncode"] = code
+        self.bench_finished()
+
+    def bench_finished(self):
+        if self.returncode is not None and not getattr(self, "bench_counted", True):
+            self.bench_counted = True
+            if self.bench_zpaq:
+                stats.zpaq += time.time() - self.bench_start
+
+
+def timed_state(f):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            stats.state += time.time() - start
+    return wrapper
+
+
+# fake-latency driver: local driver preceded by sleep, logging "<op> <bytes>" of every call
+def make_latency_driver(drivers_dir, log):
+    os.makedirs(drivers_dir + "/slow")
+    for op in ["upload", "download", "delete", "stat"]:
+        with open(drivers_dir + "/slow/" + op, "w") as f:
+            f.write("#!/bin/bash\n"
+                    "sleep $river_bench_latency\n"
+                    "size=0\n"
+                    "if [ -f \"$1\" ]; then size=$(stat -c %s \"$1\"); fi\n"
+                    "echo \"" + op + " $size\" >> " + log + "\n"
+                    "exec " + river.get_script_dir() + "/local/" + op + " \"$@\"\n")
+        os.chmod(drivers_dir + "/slow/" + op, 0o755)
+
+
+def read_transfer_log(log):
+    sent = 0
+    received = 0
+    if os.path.exists(log):
+        with open(log) as f:
+            for line in f.read().split("\n"):
+                if line.startswith("upload "):
+                    sent += int(line.split(" ")[1])
+                elif line.startswith("download "):
+                    received += int(line.split(" ")[1])
+        os.remove(log)
+    return sent, received
+
+
+def dir_size(d):
+    total = 0
+    for root, _, files in os.walk(d):
+        total += sum(os.path.getsize(root + "/" + f) for f in files)
+    return total
+
+
+# Random.randbytes needs python 3.9
+def random_bytes(rnd, n):
+    return rnd.getrandbits(8 * n).to_bytes(n, "little")
+
+
+# synthetic trees: name -> [create(dir, rnd), change(dir, rnd)], sizes are multiplied by scale
+def trees(scale):
+    def small_files(d, rnd):
+        for i in range(1000 * scale):
+            sub = d + "/" + str(i % 50)
+            os.makedirs(sub, exist_ok=True)
+            with open(sub + "/" + str(i) + ".txt", "wb") as f:
+                f.write(random_bytes(rnd, rnd.randint(100, 4000)))
+
+    def change_small_files(d, rnd):  # 10% of files change
+        for i in range(0, 1000 * scale, 10):
+            with open(d + "/" + str(i % 50) + "/" + str(i) + ".txt", "ab") as f:
+                f.write(random_bytes(rnd, 100))
+
+    def huge_files(d, rnd):
+        os.makedirs(d)
+        for i in range(2):
+            with open(d + "/" + str(i) + ".bin", "wb") as f:
+                for _ in range(16 * scale):
+                    f.write(random_bytes(rnd, 1024 * 1024))
+
+    def change_huge_files(d, rnd):  # one file grows by 1/16
+        with open(d + "/0.bin", "ab") as f:
+            f.write(random_bytes(rnd, 1024 * 1024 * scale))
+
+    return {
+        "small": [small_files, change_small_files],
+        "huge": [huge_files, change_huge_files],
+    }
+
+
+def phase(name, protocol, f, source_size, log):
+    stats.spawns = 0
+    stats.zpaq = 0.0
+    stats.state = 0.0
+    read_transfer_log(log)
+    start = time.time()
+    f()
+    wall = time.time() - start
+    sent, received = read_transfer_log(log)
+    return {
+        "wall": wall,
+        "zpaq": stats.zpaq,
+        "orchestration": max(0.0, wall - stats.zpaq),
+        "state": stats.state,
+        "spawns": stats.spawns,
+        "sent": sent if protocol == "slow" else None,
+        "received": received if protocol == "slow" else None,
+        "mb_per_second": source_size / 1024 / 1024 / wall,
+    }
+
+
+def bench_backup(scale, latency):
+    base = tempfile.mkdtemp(prefix="river-bench-")
+    river.work_dir = base + "/work"
+    log = base + "/transfers.log"
+    make_latency_driver(base + "/drivers", log)
+    river.driver_path = [base + "/drivers"] + river.driver_path
+    os.environ["river_bench_latency"] = str(latency / 1000.0)
+
+    popen = subprocess.Popen
+    load_state = river.load_state
+    save_state = river.save_state
+    load_manifest = river.load_manifest
+    subprocess.Popen = CountingPopen
+    river.load_state = timed_state(load_state)
+    river.save_state = timed_state(save_state)
+    river.load_manifest = timed_state(load_manifest)
+
+    results = {}
+    try:
+        for tree, (create, change) in trees(scale).items():
+            for protocol in ["local", "slow"]:
+                source = base + "/source-" + tree
+                target = base + "/target"
+                url = protocol + ":" + base + "/remote-" + tree + "-" + protocol
+                shutil.rmtree(source, True)
+                rnd = random.Random(42)  # same tree for every run
+                create(source, rnd)
+
+                state = {
+                    "local": {"exclude": [], "include_only": []},
+                    "keep_incremental_backup_count": 10,
+                    "keep_full_backup_count": 3,
+                    "parallel_uploads": 4,
+                    "parallel_downloads": 4,
+                    "last_backup_timestamp": 0,
+                    "full_backups": []
+                }
+                save_state(url, state, "")
+
+                def latest():
+                    return river.restore_urls(load_state(url, ""))[-1]["version"]
+
+                def restore():
+                    shutil.rmtree(target, True)
+                    river.restore(url, latest(), "", target)
+
+                def verify():
+                    river.verify_quick(url, latest(), "")
+                    river.restore(url, latest(), "", target, True)
+
+                size = dir_size(source)
+                key = tree + "/" + protocol
+                results[key + "/backup"] = phase("backup", protocol,
+                                                 lambda: river.perform_backup(url, [source], ""), size, log)
+                change(source, rnd)
+                size = dir_size(source)
+                results[key + "/incremental"] = phase("incremental", protocol,
+                                                      lambda: river.perform_backup(url, [source], ""), size, log)
+                results[key + "/restore"] = phase("restore", protocol, restore, size, log)
+                results[key + "/verify"] = phase("verify", protocol, verify, size, log)
+    finally:
+        subprocess.Popen = popen
+        river.load_state = load_state
+        river.save_state = save_state
+        river.load_manifest = load_manifest
+        river.close_sessions()
+        shutil.rmtree(base, True)
+    return results
+
+
+def print_results(results, baseline):
+    print("phase\twall s\tzpaq s\torch s\tstate s\tspawns\tsent MB\trecv MB\tMB/s" +
+          ("\torch vs base\tspawns vs base" if baseline is not None else ""))
+    regressed = False
+    for key, r in results.items():
+        def mb(v):
+            return "-" if v is None else "%.1f" % (v / 1024.0 / 1024.0)
+        line = key + "\t%.2f\t%.2f\t%.2f\t%.2f\t%d\t%s\t%s\t%.1f" % (
+            r["wall"], r["zpaq"], r["orchestration"], r["state"], r["spawns"], mb(r["sent"]), mb(r["received"]),
+            r["mb_per_second"])
+        if baseline is not None and key in baseline:
+            b = baseline[key]
+            orchestration = r["orchestration"] / max(b["orchestration"], 0.001)
+            spawns = r["spawns"] / max(b["spawns"], 1)
+            line += "\t%.2fx\t%.2fx" % (orchestration, spawns)
+            if (orchestration > 1.25 and r["orchestration"] - b["orchestration"] > 0.05) or spawns > 1.25:
+                regressed = True
+                line += "\tREGRESSION"
+        print(line)
+    return regressed
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) == 0 or args[0] == "proc":
+        bench_proc(int(args[1]) if len(args) > 1 else 50)
+        return
+
+    if args[0] != "backup":
+        sys.stderr.write("Usage: river-bench.py proc [count] | backup [--latency <ms>] [--scale <n>] "
+                         "[--save <file>] [--compare <file>]\n")
+        sys.exit(2)
+
+    options = {"--latency": "20", "--scale": "1", "--save": None, "--compare": None}
+    i = 1
+    while i < len(args):
+        if args[i] not in options or i + 1 >= len(args):
+            sys.stderr.write("Unknown option: " + args[i] + "\n")
+            sys.exit(2)
+        options[args[i]] = args[i + 1]
+        i += 2
+
+    baseline = None
+    if options["--compare"] is not None:
+        with open(options["--compare"]) as f:
+            baseline = json.load(f)
+
+    results = bench_backup(int(options["--scale"]), int(options["--latency"]))
+    regressed = print_results(results, baseline)
+
+    if options["--save"] is not None:
+        with open(options["--save"], "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,11 +10,43 @@ import tempfile
 import time
 import fcntl
 import re
+import concurrent.futures
+import selectors
+import hashlib
+import base64
+import threading
+import atexit
+import shlex
+import ctypes
+import functools
+import fnmatch
+import random
+import contextlib
+import json
+import importlib.util
+import calendar
+import errno
+import struct
+import asyncio
+import contextvars
+
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
 
 work_dir = "/tmp/river"
 use_ip_in_path = os.getenv("backup_use_ip_in_path", "true") == "false"
 backup_name_unique_counter = 0
 stdout = open("/dev/null", "w")  # sys.stdout
+state_save_interval = 60  # seconds between remote state saves while uploading
+upload_journal_file = "upload.journal"
+stream_segment_size = 64 * 1024 * 1024  # tomes are uploaded in segments of this size in streaming mode
+first_tome = "a00001.zpaq"
+tome_head_size = 1024
+restore_disk_budget = int(os.getenv("river_restore_disk_budget", "0")) * 1024 * 1024  # 0 for free disk space
+extract_args_limit = 64 * 1024  # bytes of -only patterns passed to one zpaq extract
 
 # backup config yaml format:
 #
@@ -22,6 +54,151 @@ stdout = open("/dev/null", "w")  # sys.stdout
 # local.include_only[]           array of include only
 # keep_incremental_backup_count  how many incremental backups to keep
 # keep_full_backup_count         how many full backups to keep
+# parallel_uploads               how many files to upload at once
+# parallel_downloads             how many files to download at once on restore
+# stream_upload                  upload tomes while compressing
+# segment_size                   upload tomes larger than this in segments of this size, in MB, 0 to upload whole
+# synthetic_full_backups         how many full backups in a row to seed from previous full backup
+# shards                         how many archive chains to compress in parallel
+# compression_method             zpaq method 0-5 or auto
+# compression_threads            threads of each zpaq process, 0 for default
+
+
+# timing and transfer metrics of current command
+# written at exit as json to river_metrics_json file and in prometheus text format to river_metrics_prom file
+# (for node_exporter textfile collector), if these environment variables are set
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.phases = {}   # name -> [count, seconds]
+        self.drivers = {}  # driver operation -> [calls, seconds, bytes, errors]
+        self.processes = 0
+        self.retries = 0
+        self.compression = [0, 0, 0.0, 0]  # zpaq input bytes, output bytes, seconds, runs
+
+    # times the block as phase `name`, phases may nest and repeat
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                p = self.phases.setdefault(name, [0, 0.0])
+                p[0] += 1
+                p[1] += time.time() - start
+
+    def add_driver_call(self, op, seconds, size, ok):
+        with self.lock:
+            d = self.drivers.setdefault(op, [0, 0.0, 0, 0])
+            d[0] += 1
+            d[1] += seconds
+            d[2] += size
+            if not ok:
+                d[3] += 1
+
+    def add_process(self):
+        with self.lock:
+            self.processes += 1
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def add_compression(self, input_bytes, output_bytes, seconds):
+        with self.lock:
+            self.compression[0] += input_bytes
+            self.compression[1] += output_bytes
+            self.compression[2] += seconds
+            self.compression[3] += 1
+
+    def report(self, command, target, success):
+        with self.lock:
+            return {
+                "command": command,
+                "target": target,
+                "success": success,
+                "start": self.start,
+                "seconds": time.time() - self.start,
+                "processes": self.processes,
+                "retries": self.retries,
+                "phases": {k: {"count": v[0], "seconds": v[1]} for k, v in self.phases.items()},
+                "driver": {k: {"calls": v[0], "seconds": v[1], "bytes": v[2], "errors": v[3]}
+                           for k, v in self.drivers.items()},
+                "compression": {"input_bytes": self.compression[0], "output_bytes": self.compression[1],
+                                "seconds": self.compression[2], "runs": self.compression[3]},
+            }
+
+
+metrics = Metrics()
+# metrics of backup running in current context, besides command-wide `metrics`,
+# so backups run at once by backup-all see only their own compression and uploads
+backup_metrics = contextvars.ContextVar("backup_metrics", default=None)
+metrics_json_file = os.getenv("river_metrics_json", "")
+metrics_prom_file = os.getenv("river_metrics_prom", "")
+
+
+# command-wide metrics and metrics of backup running in current context, if any
+def scoped_metrics():
+    backup = backup_metrics.get()
+    return [metrics] if backup is None else [metrics, backup]
+
+
+def prometheus_metrics(report):
+    def labels(**extra):
+        ls = dict({"command": report["command"], "target": report["target"]}, **extra)
+        return "{" + ",".join(k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                              for k, v in ls.items()) + "}"
+
+    lines = []
+
+    def metric(name, help, values):
+        lines.append("# HELP " + name + " " + help)
+        lines.append("# TYPE " + name + " gauge")
+        for ls, v in values:
+            lines.append(name + ls + " " + repr(v))
+
+    metric("river_success", "1 if last command succeeded", [(labels(), 1 if report["success"] else 0)])
+    metric("river_start_timestamp_seconds", "start time of last command", [(labels(), report["start"])])
+    metric("river_duration_seconds", "wall time of last command", [(labels(), report["seconds"])])
+    metric("river_processes", "processes started by last command", [(labels(), report["processes"])])
+    metric("river_retries", "driver operations retried by last command", [(labels(), report["retries"])])
+    metric("river_phase_seconds", "wall time of command phase",
+           [(labels(phase=k), v["seconds"]) for k, v in report["phases"].items()])
+    metric("river_phase_count", "times command phase was entered",
+           [(labels(phase=k), v["count"]) for k, v in report["phases"].items()])
+    metric("river_driver_calls", "driver operations called",
+           [(labels(op=k), v["calls"]) for k, v in report["driver"].items()])
+    metric("river_driver_seconds", "total wall time of driver operations, concurrent ones are added up",
+           [(labels(op=k), v["seconds"]) for k, v in report["driver"].items()])
+    metric("river_driver_bytes", "bytes uploaded or downloaded by driver operations",
+           [(labels(op=k), v["bytes"]) for k, v in report["driver"].items()])
+    metric("river_driver_errors", "failed driver operations",
+           [(labels(op=k), v["errors"]) for k, v in report["driver"].items()])
+    metric("river_compression_input_bytes", "bytes of changed files read by zpaq",
+           [(labels(), report["compression"]["input_bytes"])])
+    metric("river_compression_output_bytes", "bytes written by zpaq",
+           [(labels(), report["compression"]["output_bytes"])])
+    metric("river_compression_seconds", "time spent in zpaq, concurrent runs are added up",
+           [(labels(), report["compression"]["seconds"])])
+    return "\n".join(lines) + "\n"
+
+
+# replace file atomically, so collectors never read partial file
+def write_file_atomically(fname, data):
+    with open(fname + ".tmp", "w") as f:
+        f.write(data)
+    os.replace(fname + ".tmp", fname)
+
+
+def write_metrics(command, target, success):
+    report = metrics.report(command, target, success)
+    if metrics_json_file != "":
+        write_file_atomically(metrics_json_file, json.dumps(report, indent=2, sort_keys=True) + "\n")
+    if metrics_prom_file != "":
+        write_file_atomically(metrics_prom_file, prometheus_metrics(report))
 
 
 # abstraction over *nix process, supporting piping and parallel execution
@@ -33,6 +210,7 @@ class Proc:
     def __init__(self, cmd, error=None, stdin=None):
         self.cmd = cmd
         self.error = error
+        self.env = None  # environment of created process, river's if None
         self.pipes = [[self]]
         if isinstance(stdin, str):
             self.stdin = bytearray(stdin, 'utf-8')
@@ -54,42 +232,72 @@ class Proc:
     # run this proc, awaiting for result synchronously
     # stdout (where appropriate) goes to out, stderr goes to err
     def run(self, out=None, err=None):
-        pars = self._run(None, out, err)
-
-        while True:
-            has_running = False
-            error_msg = None
-            for par in pars:
-                code = par[0].poll()
-                if code is None:
-                    has_running = True
-                else:
-                    if par[0].stdout is not None:
-                        par[0].stdout.close()
-                    if code != 0 and error_msg is None:
-                        error_msg = par[1]
-
-            if error_msg is not None:
-                for par in pars:
+        self.start(out, err).wait()
+
+    # start this proc, returning RunningProc to track it
+    def start(self, out=None, err=None):
+        return RunningProc(self._run(None, out, err))
+
+    # run this proc on asyncio event loop, see async execution below
+    # if any process fails, others are killed and IOError is raised
+    # if awaiting task is cancelled, all processes are killed before CancelledError propagates
+    async def run_async(self, out=None, err=None):
+        pars = []
+        feeds = []
+        try:
+            await self._start_async(None, out, err, pars, feeds)
+            waits = {asyncio.ensure_future(p.wait()): [p, error] for p, error in pars}
+            while len(waits) > 0:
+                done, _ = await asyncio.wait(waits.keys(), return_when=asyncio.FIRST_COMPLETED)
+                for w in done:
+                    p, error = waits.pop(w)
+                    if p.returncode != 0 and error is not None:
+                        raise IOError(error)
+        finally:
+            for p, _ in pars:
+                if p.returncode is None:
                     try:
-                        par[0].kill()
+                        p.kill()
                     except OSError:
                         pass
-                raise IOError(error_msg)
+            for f in feeds:
+                f.cancel()
+            await asyncio.gather(*[p.wait() for p, _ in pars], *feeds, return_exceptions=True)
 
-            if not has_running:
-                return
-            time.sleep(0.05)
+    async def _start_async(self, in_, out, err, pars, feeds):
+        if self.cmd is not None:
+            p = await asyncio.create_subprocess_exec(*self.cmd, stdout=out, stderr=err, env=self.env,
+                                                     stdin=in_ if self.stdin is None else subprocess.PIPE)
+            metrics.add_process()
+            pars.append([p, self.error])
+            if self.stdin is not None:
+                feeds.append(asyncio.ensure_future(feed_stdin(p, self.stdin)))
+            return
+
+        for p in self.pipes:
+            if len(p) == 1:
+                await p[0]._start_async(in_, out, err, pars, feeds)
+            else:
+                r, w = os.pipe()
+                try:
+                    await p[0]._start_async(in_, w, err, pars, feeds)
+                    await p[1]._start_async(r, out, err, pars, feeds)
+                finally:
+                    os.close(r)
+                    os.close(w)
 
     def _run(self, in_, out, err):
         if self.cmd is not None:
             if self.stdin is not None:
-                p = subprocess.Popen(self.cmd, stdout=out, stdin=subprocess.PIPE, stderr=err) # stderr=subprocess.STDOUT,
+                p = subprocess.Popen(self.cmd, stdout=out, stdin=subprocess.PIPE, stderr=err, env=self.env) # stderr=subprocess.STDOUT,
+                metrics.add_process()
                 p.stdin.write(self.stdin)
                 p.stdin.close()
                 return [[p, self.error]]
             else:
-                return [[subprocess.Popen(self.cmd, stdout=out, stdin=in_, stderr=err), self.error]]
+                p = subprocess.Popen(self.cmd, stdout=out, stdin=in_, stderr=err, env=self.env)
+                metrics.add_process()
+                return [[p, self.error]]
 
         result = []
         for p in self.pipes:
@@ -119,6 +327,216 @@ class Proc:
         return Proc(["bash", "-c", "cat >" + fname], "failed to write to file" + fname)
 
 
+# processes started by Proc.start
+class RunningProc:
+
+    def __init__(self, pars):
+        self.pars = pars
+        self.waiter = ExitWaiter([par[0] for par in pars])
+
+    # True if all processes have exited successfully, False if some are still running
+    # if any process failed, kills others and raises IOError
+    def poll(self):
+        running = []
+        error_msg = None
+        for par in self.pars:
+            code = par[0].poll()
+            if code is None:
+                running.append(par)
+            else:
+                self.waiter.remove(par[0])
+                if par[0].stdout is not None:
+                    par[0].stdout.close()
+                if code != 0 and error_msg is None:
+                    error_msg = par[1]
+
+        if error_msg is not None:
+            self.kill()
+            raise IOError(error_msg)
+
+        self.pars = running
+        if len(running) == 0:
+            self.waiter.close()
+            return True
+        return False
+
+    def wait(self):
+        try:
+            while not self.poll():
+                self.waiter.wait()
+        finally:
+            self.waiter.close()
+
+    def kill(self):
+        for par in self.pars:
+            try:
+                par[0].kill()
+            except OSError:
+                pass
+        self.waiter.close()
+
+
+# blocks until any of given processes exits
+# uses pidfd where available (python 3.9+), otherwise thread per process blocked in waitid, which leaves process
+# to be reaped by Popen, and polling with growing interval where neither is available
+class ExitWaiter:
+
+    def __init__(self, procs):
+        self.fds = {}
+        self.selector = None
+        self.cond = None
+        self.exited = False
+        self.delay = 0.001
+        if hasattr(os, "pidfd_open"):
+            try:
+                self.selector = selectors.DefaultSelector()
+                for p in procs:
+                    fd = os.pidfd_open(p.pid)
+                    self.fds[p] = fd
+                    self.selector.register(fd, selectors.EVENT_READ)
+            except OSError:
+                self.close()
+                self.selector = None
+        if self.selector is None and hasattr(os, "waitid"):
+            self.cond = threading.Condition()
+            for p in procs:
+                threading.Thread(target=self._watch, args=(p.pid,), daemon=True).start()
+
+    def _watch(self, pid):
+        try:
+            os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        except ChildProcessError:
+            pass  # already reaped by Popen
+        with self.cond:
+            self.exited = True
+            self.cond.notify_all()
+
+    def remove(self, p):
+        fd = self.fds.pop(p, None)
+        if fd is not None:
+            self.selector.unregister(fd)
+            os.close(fd)
+
+    def wait(self):
+        if self.selector is not None:
+            self.selector.select()
+        elif self.cond is not None:
+            with self.cond:
+                while not self.exited:
+                    self.cond.wait()
+                self.exited = False
+        else:
+            time.sleep(self.delay)
+            self.delay = min(self.delay * 2, 0.05)
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+
+
+# async execution: coroutines run on asyncio event loop started by run_async per command
+# processes are started by asyncio.create_subprocess_exec (Proc.run_async), blocking steps like driver calls run
+# in threads of the loop (in_thread), TaskGroup runs independent steps concurrently
+engine_threads = 64  # blocking steps running at once in threads of one event loop
+
+
+async def feed_stdin(p, data):
+    try:
+        p.stdin.write(data)
+        await p.stdin.drain()
+        p.stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # process exited without reading its input, its exit code tells if that is an error
+
+
+# run coroutine on new event loop, returning its result
+def run_async(coro):
+    async def main():
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(max_workers=engine_threads))
+        return await coro
+    return asyncio.run(main())
+
+
+# await coroutines concurrently, at most `limit` at once, returning their results
+async def run_all(coros, limit=None):
+    async with TaskGroup(limit) as group:
+        for c in coros:
+            group.spawn(c)
+    return [t.result() for t in group.tasks]
+
+
+# call blocking function in thread of event loop, in context of calling task
+# thread can not be interrupted, so cancelled call is still awaited before CancelledError propagates
+async def in_thread(call, *args):
+    future = asyncio.get_running_loop().run_in_executor(None, functools.partial(
+        contextvars.copy_context().run, call, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+# runs coroutines as concurrent tasks, at most `limit` at once, None for no limit
+# first failure cancels other tasks and is re-raised when group is awaited, cancelled group cancels its tasks
+# `async with TaskGroup() as g` awaits tasks spawned in the block on exit
+class TaskGroup:
+
+    def __init__(self, limit=None):
+        self.semaphore = asyncio.Semaphore(max(1, limit)) if limit is not None else None
+        self.tasks = []
+        self.coros = []
+
+    # start coroutine as task of this group, returning the task
+    def spawn(self, coro):
+        task = asyncio.ensure_future(self._limited(coro))
+        self.tasks.append(task)
+        self.coros.append(coro)
+        return task
+
+    async def _limited(self, coro):
+        if self.semaphore is None:
+            return await coro
+        async with self.semaphore:
+            return await coro
+
+    # wait for all tasks, including ones spawned meanwhile, returning their results in spawn order
+    async def wait(self):
+        try:
+            while True:
+                pending = [t for t in self.tasks if not t.done()]
+                for t in self.tasks:
+                    if t.done() and not t.cancelled() and t.exception() is not None:
+                        raise t.exception()
+                if len(pending) == 0:
+                    return [t.result() for t in self.tasks]
+                await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+        except BaseException:
+            await self.cancel()
+            raise
+
+    async def cancel(self):
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for c in self.coros:
+            c.close()  # coroutines of tasks cancelled before their turn were never started
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.wait()
+        else:
+            await self.cancel()
+
+
 def get_script_dir():
     import inspect
     if getattr(sys, 'frozen', False):  # py2exe, PyInstaller, cx_Freeze
@@ -149,27 +567,766 @@ def parse_url(url):
     return Url()
 
 
+# extra directories with drivers, searched before drivers next to river.py
+driver_path = [d for d in os.getenv("river_driver_path", "").split(":") if d != ""]
+
+
+def driver_dir(protocol):
+    for d in driver_path:
+        if os.path.isdir(d + "/" + protocol):
+            return d + "/" + protocol
+    return get_script_dir() + "/" + protocol
+
+
+# in-process python drivers: driver folder may contain driver.py module with functions
+# upload(from_file, to_file), download(from_file, to_file), delete(path) and optionally stat(path),
+# returning [size, sha256 or None]; they raise exception on error
+# if module is present, it is used instead of driver executables, unless river_python_drivers=false
+# or module has available() function returning False, e.g. when it is not configured
+# module defining throttle(size) has it replaced by throttle_transfer and calls it for chunks of bytes it moves,
+# which keeps its transfers under bandwidth limit
+use_python_drivers = os.getenv("river_python_drivers", "true") != "false"
+python_drivers = {}  # protocol -> module or None
+python_drivers_lock = threading.Lock()
+
+
+def python_driver(protocol):
+    if not use_python_drivers:
+        return None
+    with python_drivers_lock:
+        if protocol not in python_drivers:
+            fname = driver_dir(protocol) + "/driver.py"
+            module = None
+            if os.path.isfile(fname):
+                spec = importlib.util.spec_from_file_location("river_driver_" + re.sub(r'\W', "_", protocol), fname)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                if hasattr(module, "throttle"):
+                    module.throttle = throttle_transfer
+            python_drivers[protocol] = module
+        module = python_drivers[protocol]
+    if module is not None and hasattr(module, "available") and not module.available():
+        return None
+    return module
+
+
+# bandwidth limit profile: "<MB/s>" or comma-separated "<HH:MM>-<HH:MM>=<MB/s>" time-of-day ranges
+# ranges may wrap over midnight, times not covered by any range and 0 MB/s mean no limit
+# returns [[from minute, to minute, bytes per second]]
+def parse_bandwidth_profile(spec):
+    def minute(hhmm):
+        h, m = hhmm.split(":")
+        if not 0 <= int(h) <= 24 or not 0 <= int(m) < 60:
+            raise ValueError(hhmm)
+        return int(h) * 60 + int(m)
+
+    profile = []
+    try:
+        for part in [p.strip() for p in spec.split(",") if p.strip() != ""]:
+            if "=" not in part:
+                profile.append([0, 24 * 60, float(part) * 1024 * 1024])
+                continue
+            times, rate = part.split("=")
+            start, end = times.split("-")
+            profile.append([minute(start), minute(end), float(rate) * 1024 * 1024])
+    except ValueError:
+        raise Exception("Invalid bandwidth limit: " + spec)
+    return profile
+
+
+# bytes per second allowed at datetime t, 0 for no limit
+def bandwidth_at(profile, t):
+    m = t.hour * 60 + t.minute
+    for start, end, rate in profile:
+        if (start <= m < end) if start <= end else (m >= start or m < end):
+            return rate
+    return 0
+
+
+# governs all driver uploads and downloads of the command:
+# - bandwidth: token bucket refilled at current profile rate, transfers start only while bucket is not in debt
+#   and their bytes are throttled while they move:
+#   python drivers defining throttle(size) charge every chunk they move to the bucket (see throttle_transfer),
+#   other transfers reserve their estimated size when they start and settle actual size when they complete,
+#   driver scripts among them get current rate in $river_rate_limit and pass their data through `pv -L`,
+#   so neither one transfer nor transfers running at once exceed the limit
+# - concurrency (if adaptive): number of transfers running at once starts at 2 and grows by one while throughput
+#   of last window of transfers improves, halves on errors and on throughput drops below half of best seen,
+#   parallel_uploads and parallel_downloads remain upper bounds
+# - retries: failed transfer is retried with exponential backoff, after halving concurrency
+class TransferGovernor:
+
+    def __init__(self, profile, adaptive):
+        self.profile = profile
+        self.adaptive = adaptive
+        self.cond = threading.Condition()
+        self.tokens = None
+        self.refilled = time.time()
+        self.limit = 2
+        self.active = 0
+        self.waiting = 0
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_transfers = 0
+        self.last_throughput = None
+        self.best_throughput = 0
+        self.average_size = 0  # of completed transfers, estimate for transfers of unknown size
+
+    # bytes per second allowed now, 0 for no limit
+    def rate(self):
+        return bandwidth_at(self.profile, datetime.datetime.now())
+
+    # called under lock, returns seconds to wait for bandwidth
+    def _bandwidth_wait(self):
+        rate = self.rate()
+        if rate <= 0:
+            self.tokens = None
+            return 0
+        now = time.time()
+        if self.tokens is None:
+            self.tokens = rate
+        self.tokens = min(rate, self.tokens + (now - self.refilled) * rate)  # burst of one second
+        self.refilled = now
+        return 0 if self.tokens >= 0 else -self.tokens / rate
+
+    # returns bytes reserved for transfer of estimated size, nothing is reserved for metered transfers
+    def acquire(self, estimate, metered=False):
+        with self.cond:
+            self.waiting += 1
+            while True:
+                delay = self._bandwidth_wait()
+                if delay > 0:
+                    self.cond.wait(delay)
+                elif self.adaptive and self.active >= self.limit:
+                    self.cond.wait()
+                else:
+                    break
+            self.waiting -= 1
+            self.active += 1
+            if self.tokens is None or metered:
+                return 0
+            reserved = estimate if estimate is not None else self.average_size
+            self.tokens -= reserved
+            return reserved
+
+    def release(self, size, ok, reserved, metered=False):
+        with self.cond:
+            self.active -= 1
+            if self.tokens is not None and not metered:
+                self.tokens -= size - reserved
+            if ok:
+                self.average_size = size if self.average_size == 0 else (self.average_size + size) / 2
+            if not ok:
+                self.limit = max(1, self.limit // 2)
+            else:
+                self._tune(size)
+            self.cond.notify_all()
+
+    # called under lock after successful transfer
+    def _tune(self, size):
+        self.window_bytes += size
+        self.window_transfers += 1
+        if self.window_transfers < max(2, self.limit):
+            return
+        throughput = self.window_bytes / max(0.001, time.time() - self.window_start)
+        if throughput < self.best_throughput / 2:
+            self.limit = max(1, self.limit // 2)
+        elif self.waiting > 0 and (self.last_throughput is None or throughput > self.last_throughput * 1.1):
+            self.limit += 1
+        self.best_throughput = max(self.best_throughput, throughput)
+        self.last_throughput = throughput
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_transfers = 0
+
+    # charges size bytes moved by running transfer, blocking while bucket is in debt
+    def throttle(self, size):
+        with self.cond:
+            self._bandwidth_wait()
+            if self.tokens is None:
+                return
+            self.tokens -= size
+            delay = self._bandwidth_wait()
+        time.sleep(delay)
+
+    # runs transfer call(), size() is bytes it moved, estimate is bytes it will move or None if not known
+    # metered transfer charges its bytes by throttle() as it moves them
+    def transfer(self, call, size, estimate=None, metered=False):
+        attempt = 0
+        while True:
+            reserved = self.acquire(estimate, metered)
+            ok = False
+            try:
+                r = call()
+                ok = True
+                return r
+            except IOError:
+                if attempt >= transfer_retries:
+                    raise
+            finally:
+                self.release(size() if ok else 0, ok, reserved, metered)
+            metrics.add_retry()
+            time.sleep(transfer_retry_delay * 2 ** attempt)
+            attempt += 1
+
+
+transfer_retries = int(os.getenv("river_transfer_retries", "2"))
+transfer_retry_delay = 1.0  # seconds before first retry, doubled for every next one
+governor = None
+
+
+def transfer_governor():
+    global governor
+    if governor is None:
+        governor = TransferGovernor(parse_bandwidth_profile(os.getenv("river_bandwidth_limit", "")),
+                                    os.getenv("river_adaptive_concurrency", "false") == "true")
+    return governor
+
+
+# set as throttle(size) of python drivers defining it, they call it for every chunk of bytes they upload or download
+def throttle_transfer(size):
+    transfer_governor().throttle(size)
+
+
+# driver operation: runs driver script or, if driver provides `session` executable,
+# sends the operation to long-lived driver session
+#
+# session protocol: river writes one operation per line to session stdin,
+# operation name and arguments separated by tabs, e.g. "upload\t<from-file>\t<to-file>"
+# session replies with single line to stdout: "ok", "ok <operation output>" or "error <message>"
+# session stderr is treated as driver stdout, session exits on stdin EOF
+class DriverProc(Proc):
+
+    # probe: operation checks whether remote file exists and is expected to fail,
+    # it is not retried and does not affect transfer governor
+    def __init__(self, protocol, op, args, error, probe=False):
+        Proc.__init__(self, [driver_dir(protocol) + "/" + op] + args, error)
+        self.protocol = protocol
+        self.op = op
+        self.args = args
+        self.probe = probe
+
+    def run(self, out=None, err=None):
+        module = python_driver(self.protocol)
+        transfer = self.op in ["upload", "download"]
+
+        def call():
+            if module is not None:
+                return self._call_python()
+            # rate limited transfer runs driver script, which can throttle its data by $river_rate_limit
+            rate = int(transfer_governor().rate()) if transfer else 0
+            self.env = dict(os.environ, river_rate_limit=str(rate)) if rate > 0 else None
+            session = acquire_session(self.protocol) if rate == 0 else None
+            if session is None:
+                return Proc.run(self, out, err)
+            self._call(session)
+        if transfer and not self.probe:
+            transfer_governor().transfer(lambda: self._measure(call), self._transferred, self._expected(),
+                                         module is not None and hasattr(module, "throttle"))
+        else:
+            self._measure(call)
+
+    # driver calls go through sessions, python drivers and transfer governor, all blocking, so they run in thread
+    async def run_async(self, out=None, err=None):
+        await in_thread(self.run, out, err)
+
+    # run, returning what driver printed to stdout or replied after "ok"
+    def output(self):
+        def call():
+            if python_driver(self.protocol) is not None:
+                r = self._call_python()
+                return " ".join(str(e) for e in r if e is not None) if isinstance(r, (list, tuple)) else ""
+            session = acquire_session(self.protocol)
+            if session is None:
+                with tempfile.NamedTemporaryFile(prefix="river-c-") as f:
+                    Proc.run(self, f)
+                    f.seek(0)
+                    return f.read().decode("utf-8")
+            return self._call(session)
+        return self._measure(call)
+
+    def _measure(self, call):
+        start = time.time()
+        try:
+            r = call()
+        except Exception:
+            for m in scoped_metrics():
+                m.add_driver_call(self.op, time.time() - start, 0, False)
+            raise
+        for m in scoped_metrics():
+            m.add_driver_call(self.op, time.time() - start, self._transferred(), True)
+        return r
+
+    # bytes upload will move, None for download, its size is not known before
+    def _expected(self):
+        if self.op != "upload" or not os.path.isfile(self.args[0]):
+            return None
+        return os.path.getsize(self.args[0])
+
+    # bytes moved by successful upload or download
+    def _transferred(self):
+        f = {"upload": 0, "download": 1}.get(self.op)
+        if f is None or not os.path.isfile(self.args[f]):
+            return 0
+        return os.path.getsize(self.args[f])
+
+    def _call_python(self):
+        f = getattr(python_driver(self.protocol), self.op, None)
+        if f is None:
+            raise IOError(self.error + ": driver " + self.protocol + " does not support " + self.op)
+        try:
+            return f(*self.args)
+        except Exception as e:
+            raise IOError(self.error + ": " + (str(e) or type(e).__name__))
+
+    def _call(self, session):
+        try:
+            return session.call(self.op, self.args, self.error)
+        except DriverSessionError:
+            session.close()
+            raise
+        finally:
+            if session.p.returncode is None:
+                release_session(self.protocol, session)
+
+
+class DriverSessionError(IOError):
+    pass
+
+
+class DriverSession:
+
+    def __init__(self, protocol):
+        self.p = subprocess.Popen([driver_dir(protocol) + "/session"],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stdout)
+        metrics.add_process()
+
+    def call(self, op, args, error):
+        try:
+            self.p.stdin.write(("\t".join([op] + args) + "\n").encode("utf-8"))
+            self.p.stdin.flush()
+            reply = self.p.stdout.readline().decode("utf-8").rstrip("\n")
+        except OSError:
+            reply = ""
+        if reply == "":
+            raise DriverSessionError(error + ": driver session terminated")
+        if reply != "ok" and not reply.startswith("ok "):
+            raise IOError(error + ": " + reply)
+        return reply[3:]
+
+    def close(self):
+        try:
+            self.p.stdin.close()
+        except OSError:
+            pass
+        self.p.wait()
+
+
+sessions_lock = threading.Lock()
+idle_sessions = {}  # protocol -> [DriverSession], None if driver has no session support
+
+
+def has_session(protocol):
+    return os.access(driver_dir(protocol) + "/session", os.X_OK)
+
+
+# take idle session of this driver or start new one, None if driver has no sessions
+def acquire_session(protocol):
+    with sessions_lock:
+        if protocol not in idle_sessions:
+            idle_sessions[protocol] = [] if has_session(protocol) else None
+        if idle_sessions[protocol] is None:
+            return None
+        if len(idle_sessions[protocol]) > 0:
+            return idle_sessions[protocol].pop()
+    return DriverSession(protocol)
+
+
+def release_session(protocol, session):
+    with sessions_lock:
+        idle_sessions[protocol].append(session)
+
+
+def close_sessions():
+    with sessions_lock:
+        for protocol in idle_sessions:
+            for session in idle_sessions[protocol] or []:
+                session.close()
+        idle_sessions.clear()
+
+
+atexit.register(close_sessions)
+
+
+# river keeps one ssh master connection per host for the whole command
+# ssh driver scripts pass $SSH_OPTS to ssh, so ControlPath added there routes them through the master
+# if master can not be started, ssh connects directly as usual
+# master exits once idle for ssh_control_persist seconds, so it does not outlive river killed before exit handlers,
+# next ssh call to the host then becomes master again by ControlMaster=auto
+ssh_multiplex = os.getenv("river_ssh_multiplex", "true") != "false"
+ssh_control_persist = 60
+ssh_lock = threading.Lock()
+ssh_control_dir = None
+ssh_masters = {}  # host -> True if master is running
+ssh_connecting = {}  # host -> threading.Event set once its master is started or failed
+ssh_base_opts = None
+
+
+def ssh_control_opts():
+    return ["-o", "ControlPath=" + ssh_control_dir + "/%C", "-o", "ControlMaster=auto",
+            "-o", "ControlPersist=" + str(ssh_control_persist)]
+
+
+# connecting is slow and may time out, so it runs outside of ssh_lock, not delaying calls to other hosts
+def open_ssh_master(path):
+    global ssh_control_dir, ssh_base_opts
+    host = path.split(":")[0]
+
+    with ssh_lock:
+        if not ssh_multiplex or host in ssh_masters:
+            return
+        connecting = ssh_connecting.get(host)
+        if connecting is None:
+            if ssh_control_dir is None:
+                ssh_base_opts = os.environ.get("SSH_OPTS", "")
+                if "ControlPath" in ssh_base_opts:  # multiplexing is configured by user
+                    ssh_masters[host] = False
+                    return
+                ssh_control_dir = tempfile.mkdtemp(prefix="river-ssh-")
+                os.environ["SSH_OPTS"] = ssh_base_opts + " " + " ".join(ssh_control_opts())
+            ssh_connecting[host] = threading.Event()
+            cmd = ["ssh", "-o", "ControlMaster=yes"] + shlex.split(ssh_base_opts) + ssh_control_opts() + \
+                  ["-f", "-N", host]
+    if connecting is not None:  # other thread starts master of this host
+        connecting.wait()
+        return
+
+    try:
+        Proc(cmd, "ssh connection to " + host + " failed").run(stdout, stdout)
+        started = True
+    except IOError:
+        started = False
+    with ssh_lock:
+        ssh_masters[host] = started
+        ssh_connecting.pop(host).set()
+
+
+def close_ssh_masters():
+    global ssh_control_dir
+    with ssh_lock:
+        for host in ssh_masters:
+            if ssh_masters[host]:
+                try:
+                    Proc(["ssh"] + shlex.split(ssh_base_opts) + ssh_control_opts() + ["-O", "exit", host]) \
+                        .run(stdout, stdout)
+                except IOError:
+                    pass
+        ssh_masters.clear()
+        if ssh_control_dir is not None:
+            shutil.rmtree(ssh_control_dir, True)
+            ssh_control_dir = None
+            os.environ["SSH_OPTS"] = ssh_base_opts
+
+
+atexit.register(close_ssh_masters)
+
+
+def open_transport(u):
+    if u.protocol == "ssh":
+        open_ssh_master(u.path)
+
+
 # upload single file
 def upload(src, dst):
     u = parse_url(dst)
-    return Proc([get_script_dir() + "/" + u.protocol + "/upload", src, u.path], "Upload " + src + " to " + dst + " failed")
+    open_transport(u)
+    return DriverProc(u.protocol, "upload", [src, u.path], "Upload " + src + " to " + dst + " failed")
 
 
 # download single file
-def download(src, dst):
+def download(src, dst, probe=False):
     u = parse_url(src)
-    return Proc([get_script_dir() + "/" + u.protocol + "/download", u.path, dst], "Download " + src + " to " + dst + " failed")
+    open_transport(u)
+    return DriverProc(u.protocol, "download", [u.path, dst], "Download " + src + " to " + dst + " failed", probe)
 
 
 def delete(src):
     u = parse_url(src)
-    return Proc([get_script_dir() + "/" + u.protocol + "/delete", u.path], "Delete " + src + " failed")
+    open_transport(u)
+    return DriverProc(u.protocol, "delete", [u.path], "Delete " + src + " failed")
+
+
+# copy remote file to other place of the same remote without transferring it through this host
+# optional driver operation, `copy <from-file> <to-file>`
+def remote_copy(src, dst):
+    u = parse_url(src)
+    open_transport(u)
+    return DriverProc(u.protocol, "copy", [u.path, parse_url(dst).path], "Copy " + src + " to " + dst + " failed")
+
+
+def has_remote_copy(protocol):
+    if python_driver(protocol) is not None:
+        return hasattr(python_driver(protocol), "copy")
+    return os.access(driver_dir(protocol) + "/copy", os.X_OK)
+
+
+# size and, if driver can compute it, sha256 of remote file: [size, sha256 or None]
+# optional driver operation, `stat <remote file>` prints "<size> [<sha256>]"
+def stat(src):
+    u = parse_url(src)
+    open_transport(u)
+    if python_driver(u.protocol) is not None:
+        if not hasattr(python_driver(u.protocol), "stat"):
+            raise IOError("Driver " + u.protocol + " does not support stat")
+    elif not os.access(driver_dir(u.protocol) + "/stat", os.X_OK) and not has_session(u.protocol):
+        raise IOError("Driver " + u.protocol + " does not support stat")
+    out = DriverProc(u.protocol, "stat", [u.path], "Stat " + src + " failed").output().split()
+    if len(out) == 0:
+        raise IOError("Stat " + src + " failed: no output")
+    return [int(out[0]), out[1] if len(out) > 1 else None]
 
 
 def full_local_dir(url):
     return work_dir + "/" + re.sub(r'\W', ".", url)
 
 
+# exclusive lock on local directory of url, held by backups and restores of this url
+class UrlLock:
+
+    def __init__(self, url):
+        self.fname = full_local_dir(url) + ".lock"
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+        self.f = open(self.fname, "w")
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+# change journal: `watch` command records changed paths under backup directories, so incremental backup can pass
+# zpaq only these paths instead of letting it scan whole directories. Paths passed to zpaq that no longer exist
+# are marked deleted in the archive, whole subtree for directories.
+# journal lines are absolute paths; "start" and "overflow" lines mean changes may have been missed since last backup
+# journal is kept outside local directory of url, which backup cleans
+change_journal_limit = int(os.getenv("river_change_journal_limit", "10000"))  # more paths are collapsed to parents
+watch_flush_interval = 1.0  # seconds between journal writes of watcher
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+
+
+def change_journal_file(url):
+    return full_local_dir(url) + ".changes"
+
+
+# held by running watcher, contains directories it watches once all watches are set up
+def watch_lock_file(url):
+    return full_local_dir(url) + ".watch"
+
+
+def append_change_journal(url, lines):
+    fname = change_journal_file(url)
+    while True:
+        with open(fname, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino != os.stat(fname).st_ino:
+                    continue  # taken by backup while we waited for lock
+            except FileNotFoundError:
+                continue
+            f.write("".join(line + "\n" for line in lines))
+            return
+
+
+# moves journal to <journal>.taken, where it stays until backup using it is committed, returns taken lines
+def take_change_journal(url):
+    fname = change_journal_file(url)
+    taken = fname + ".taken"
+    if os.path.exists(fname):
+        with open(fname) as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            data = f.read()
+            with open(taken, "a") as t:
+                t.write(data)
+                t.flush()
+                os.fsync(t.fileno())
+            os.remove(fname)
+    if not os.path.exists(taken):
+        return []
+    with open(taken) as f:
+        return [line for line in f.read().split("\n") if line != ""]
+
+
+def discard_change_journal(url):
+    if os.path.exists(change_journal_file(url) + ".taken"):
+        os.remove(change_journal_file(url) + ".taken")
+
+
+# directories watched by running watcher of url, None if there is no watcher or it is not ready yet
+def watched_dirs(url):
+    fname = watch_lock_file(url)
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            dirs = [d for d in f.read().split("\n") if d != ""]
+            return dirs if len(dirs) > 0 else None
+        fcntl.flock(f, fcntl.LOCK_UN)
+        return None
+
+
+def is_under(path, d):
+    return path == d or path.startswith(d.rstrip("/") + "/")
+
+
+# paths to pass zpaq instead of dirs, expressed relative to dirs the same way full scan stores them
+# None if full scan is needed
+def changed_paths(url, dirs, journal):
+    watched = watched_dirs(url)
+    if watched is None or "start" in journal or "overflow" in journal:
+        return None
+    roots = [[d.rstrip("/") or "/", os.path.abspath(d)] for d in dirs]
+    if not all(any(is_under(ad, w) for w in watched) for _, ad in roots):
+        return None
+
+    paths = set()
+    for line in journal:
+        for d, ad in roots:
+            if is_under(line, ad):
+                rel = os.path.relpath(line, ad)
+                paths.add(d if rel == "." else d.rstrip("/") + "/" + rel)
+                break
+
+    while True:
+        reduced = []
+        for p in sorted(paths):  # parent sorts right before its children
+            if len(reduced) == 0 or not is_under(p, reduced[-1]):
+                reduced.append(p)
+        collapsed = set(p if p in [d for d, _ in roots] else os.path.dirname(p) for p in reduced)
+        if len(reduced) <= change_journal_limit or collapsed == set(reduced):  # only roots left
+            return reduced
+        paths = collapsed
+
+
+# inotify watches of directory trees
+class Inotify:
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise IOError("inotify_init1 failed: " + os.strerror(ctypes.get_errno()))
+        self.watches = {}  # wd -> directory
+
+    def add_tree(self, path):
+        for root, dirs, _ in os.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, root.encode("utf-8", "surrogateescape"), watch_mask)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e in [errno.ENOENT, errno.ENOTDIR]:  # removed while we walked, event on its parent tells that
+                    dirs[:] = []
+                    continue
+                raise IOError("inotify_add_watch on " + root + " failed: " + os.strerror(e))
+            self.watches[wd] = root
+
+    def remove_tree(self, path):
+        for wd, d in list(self.watches.items()):
+            if is_under(d, path):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    # [[path, mask]] of pending events, path is None on overflow
+    def read(self):
+        data = os.read(self.fd, 1024 * 1024)
+        events = []
+        i = 0
+        while i < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, i)
+            name = data[i + 16:i + 16 + length].rstrip(b"\0").decode("utf-8", "surrogateescape")
+            i += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                events.append([None, mask])
+            elif wd in self.watches:
+                events.append([self.watches[wd] + ("/" + name if name != "" else ""), mask])
+                if mask & IN_IGNORED:
+                    del self.watches[wd]
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+# records changes under dirs to change journal of url until stop event is set
+def watch_changes(url, dirs, stop):
+    dirs = [os.path.abspath(d) for d in dirs]
+    os.makedirs(work_dir, exist_ok=True)
+    with open(watch_lock_file(url), "a+") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise IOError("Another watcher is already running for " + url)
+        lock.truncate(0)
+        inotify = Inotify()
+        try:
+            for d in dirs:
+                inotify.add_tree(d)
+            append_change_journal(url, ["start"])  # changes before watches were set up are unknown
+            lock.write("".join(d + "\n" for d in dirs))
+            lock.flush()
+
+            selector = selectors.DefaultSelector()
+            selector.register(inotify.fd, selectors.EVENT_READ)
+            changes = set()
+            last_flush = time.time()
+            while not stop.is_set():
+                if len(selector.select(watch_flush_interval)) > 0:
+                    for path, mask in inotify.read():
+                        if path is None:
+                            changes.add("overflow")
+                        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                            if path in dirs:  # parent of backup directory is not watched, nothing tells where it went
+                                changes.add("overflow")
+                        elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                            inotify.remove_tree(path)
+                            changes.add(path)
+                        elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                            inotify.add_tree(path)
+                            changes.add(path)
+                        elif not mask & IN_IGNORED:
+                            changes.add(path)
+                if len(changes) > 0 and time.time() - last_flush >= watch_flush_interval:
+                    append_change_journal(url, sorted(changes))
+                    changes = set()
+                    last_flush = time.time()
+            if len(changes) > 0:
+                append_change_journal(url, sorted(changes))
+            selector.close()
+        finally:
+            inotify.close()
+            lock.truncate(0)
+
+
 def full_remote_dir(url, full_backup_name):
     d = url
 
@@ -179,64 +1336,343 @@ def full_remote_dir(url, full_backup_name):
     return d + "/" + full_backup_name
 
 
-def compress(tmp_dir, options):
+def compress_proc(tmp_dir, options):
     index_file = "a00000.zpaq"
     zpaq_command = [get_script_dir() + "/zpaq",
                     "add",
                     tmp_dir + "/a?????"] + options + ["-index", tmp_dir + "/" + index_file]
+    return Proc(zpaq_command, "zpaq invocation failed")
+
 
+# zpaq add summary on stderr: "<old> + (<input> -> <after dedupe> -> <compressed>) = <new> MB", "<n> seconds ..."
+zpaq_summary_re = re.compile(r"\(([\d.]+) -> [\d.]+ -> ([\d.]+)\) = [\d.]+ MB")
+zpaq_seconds_re = re.compile(r"^([\d.]+) seconds", re.M)
+
+
+def record_compression(output):
+    summary = zpaq_summary_re.search(output)
+    seconds = zpaq_seconds_re.search(output)
+    if summary is not None and seconds is not None:
+        for m in scoped_metrics():
+            m.add_compression(int(float(summary.group(1)) * 1024 * 1024),
+                              int(float(summary.group(2)) * 1024 * 1024), float(seconds.group(1)))
+
+
+async def compress(tmp_dir, options):
     with tempfile.NamedTemporaryFile(prefix="river-c-") as f:
         try:
-            Proc(zpaq_command, "zpaq invocation failed").run(stdout, f)
+            await compress_proc(tmp_dir, options).run_async(stdout, f)
         except Exception as e:
             f.seek(0)
             sys.stderr.write(f.read().decode('utf-8'))
+            return
+        f.seek(0)
+        record_compression(f.read().decode("utf-8", "replace"))
+
+
+# compress like compress() does, yielding tome segments as soon as zpaq has written them
+# yields None while no new segment is ready
+# zpaq rewrites tome header on completion, so first segment of a tome is never yielded
+async def stream_compress(tmp_dir, options, segment_size):
+    existing = set(os.listdir(tmp_dir))
+    next_segment = {}
+
+    with tempfile.NamedTemporaryFile(prefix="river-c-") as f:
+        running = asyncio.ensure_future(compress_proc(tmp_dir, options).run_async(stdout, f))
+        try:
+            while True:
+                if running.done():
+                    f.seek(0)
+                    if running.exception() is not None:
+                        sys.stderr.write(f.read().decode('utf-8'))
+                    else:
+                        record_compression(f.read().decode("utf-8", "replace"))
+                    return
+
+                for tome in sorted(os.listdir(tmp_dir)):
+                    if tome in existing or not tome_name_re.match(tome):
+                        continue
+                    n = next_segment.get(tome, 1)
+                    size = os.path.getsize(tmp_dir + "/" + tome)
+                    while (n + 1) * segment_size <= size:
+                        yield segment_name(tome, n)
+                        n += 1
+                    next_segment[tome] = n
+                yield None
+        finally:
+            running.cancel()
+            await asyncio.gather(running, return_exceptions=True)
+
+
+tome_name_re = re.compile(r"^a\d{5}\.zpaq$")
+segment_name_re = re.compile(r"^(.*)\.s(\d{4,})$")
+
+
+def segment_name(fname, n):
+    return fname + ".s" + str(n).zfill(4)
+
+
+# file name and segment number of upload unit, segment is None if unit is the whole file
+def parse_segment(unit):
+    m = segment_name_re.match(unit)
+    if m is None:
+        return unit, None
+    return m.group(1), int(m.group(2))
+
+
+# upload units for local files: whole files or, if segment_size is set, segments of files larger than it
+def upload_units(local_dir, files, segment_size):
+    if segment_size == 0:
+        return list(files)
+    units = []
+    for f in files:
+        size = os.path.getsize(local_dir + "/" + f)
+        if size <= segment_size:
+            units.append(f)
+        else:
+            units += [segment_name(f, n) for n in range((size + segment_size - 1) // segment_size)]
+    return units
+
+
+def copy_range(src, dst, offset, length):
+    with open(src, "rb") as i, open(dst, "wb") as o:
+        i.seek(offset)
+        while length > 0:
+            buf = i.read(min(length, 1024 * 1024))
+            if len(buf) == 0:
+                break
+            o.write(buf)
+            length -= len(buf)
+
+
+# free disk space of already uploaded part of local file, if supported by filesystem
+def punch_hole(fname, offset, length):
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = os.open(fname, os.O_WRONLY)
+        try:
+            libc.fallocate(fd, 3, ctypes.c_int64(offset), ctypes.c_int64(length))  # PUNCH_HOLE | KEEP_SIZE
+        finally:
+            os.close(fd)
+    except (OSError, AttributeError):
+        pass
+
+
+# uploads one segment of local file, copying it to temporary file first
+class SegmentUpload:
+
+    def __init__(self, local_dir, remote_dir, unit, segment_size):
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.unit = unit
+        self.segment_size = segment_size
+
+    def run(self, out=None):
+        fname, n = parse_segment(self.unit)
+        seg = self.local_dir + "/segments/" + self.unit
+        os.makedirs(os.path.dirname(seg), exist_ok=True)
+        copy_range(self.local_dir + "/" + fname, seg, n * self.segment_size, self.segment_size)
+        try:
+            upload(seg, self.remote_dir + "/" + self.unit).run(out)
+        finally:
+            os.remove(seg)
+
+    async def run_async(self, out=None):
+        await in_thread(self.run, out)
+
+
+# state encryption, compatible with `openssl aes-256-cbc -a -md sha256 -pbkdf2`
+# done in-process if cryptography package is available, by openssl otherwise
+openssl_salt_magic = b"Salted__"
+openssl_pbkdf2_iterations = 10000
+state_salt = os.urandom(8)  # one salt per command, so key is derived once for all state saves
+derived_keys = {}
+
+
+def derive_key(password, salt):
+    k = (password, salt)
+    if k not in derived_keys:
+        derived_keys[k] = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt,
+                                              openssl_pbkdf2_iterations, 48)
+    return derived_keys[k]
+
+
+def encrypt_state(data, password):
+    if Cipher is None:
+        with tempfile.NamedTemporaryFile(prefix="river-c-") as f:
+            Proc(["openssl", "aes-256-cbc", "-a", "-md", "sha256", "-pbkdf2", "-k", password],
+                 "state encryption failed", data).run(f)
+            f.seek(0)
+            return f.read()
+
+    key = derive_key(password, state_salt)
+    padder = padding.PKCS7(128).padder()
+    encryptor = Cipher(algorithms.AES(key[:32]), modes.CBC(key[32:])).encryptor()
+    encrypted = encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+    return base64.encodebytes(openssl_salt_magic + state_salt + encrypted)
+
+
+def decrypt_state(data, password):
+    if Cipher is None:
+        with tempfile.NamedTemporaryFile(prefix="river-c-") as f:
+            Proc(["openssl", "aes-256-cbc", "-a", "-d", "-md", "sha256", "-pbkdf2", "-k", password],
+                 "state decryption failed, invalid password?", data).run(f)
+            f.seek(0)
+            return f.read()
+
+    try:
+        raw = base64.b64decode(data)
+        if not raw.startswith(openssl_salt_magic):
+            raise ValueError("no salt")
+        key = derive_key(password, raw[8:16])
+        decryptor = Cipher(algorithms.AES(key[:32]), modes.CBC(key[32:])).decryptor()
+        unpadder = padding.PKCS7(128).unpadder()
+        return unpadder.update(decryptor.update(raw[16:]) + decryptor.finalize()) + unpadder.finalize()
+    except ValueError:
+        raise IOError("state decryption failed, invalid password?")
 
 
 # local.exclude[]                array of exclusions
 # local.include_only[]           array of include only
 # keep_incremental_backup_count  how many incremental backups to keep
 # keep_full_backup_count         how many full backups to keep
+# parallel_uploads               how many files to upload at once
+# parallel_downloads             how many files to download at once on restore
+# stream_upload                  upload tomes while compressing
+# segment_size                   upload tomes larger than this in segments of this size, in MB, 0 to upload whole
+# synthetic_full_backups         how many full backups in a row to seed from previous full backup
+# shards                         how many archive chains to compress in parallel
+# compression_method             zpaq method 0-5 or auto
+# compression_threads            threads of each zpaq process, 0 for default
 #
 #  last_backup_timestamp: long
+#  state_format: 2              # index.yaml only holds head fields, see save_state
 #  full_backups[].name
 #  full_backups[].index_version: string
 #  full_backups[].incremental_backups[] # incremental backup timestamp
+#  full_backups[].manifest      # true if full backup has manifest.yaml
+#  full_backups[].seed_from     # previous full backup, while synthetic full backup is being seeded from it
+#  full_backups[].synthetic_depth  # how many synthetic full backups in a row this one is
+#  full_backups[].base_version  # zpaq versions seeded from previous chain, see seed_full_backup
+#  full_backups[].index_size    # this and below are kept in manifest.yaml of full backup
+#  full_backups[].index_sha256
+#  full_backups[].tomes{}       # see record_tomes
+#  full_backups[].shards[]      # chains of sharded full backup: name, index_version, index_size, index_sha256,
+#                               # tomes and entries, top-level entries of backup directories in this shard
 #  upload.files_uploaded[]
 #  upload.files_left[]
+#  upload.segment_size
+#  upload.hashes{}              # sha256 of uploaded files
+#  upload.shard_entries[]       # entries of shards, recorded on commit
+#  compression_stats.upload_bps  # moving averages of upload throughput of all uploads together
+#  compression_stats.methods{}.input_bps  # and per zpaq method, of input read by all zpaq runs together
+#  compression_stats.methods{}.ratio      # and compressed to input size
+state_format = 2
+full_backup_head_keys = ["name", "index_version", "incremental_backups", "manifest", "seed_from", "synthetic_depth",
+                         "base_version"]
+
+# manifests loaded since last load_state, per url: full backup name -> manifest yaml as last loaded or saved
+# None means manifest was migrated from single-file state and was never saved
+loaded_manifests = {}
+
+
+def load_document(remote, password):
+    with metrics.phase("state_load"):
+        with tempfile.NamedTemporaryFile(prefix="river-c-") as f:
+            download(remote, f.name).run(stdout)
+            with open(f.name, "rb") as d:  # driver may have replaced the file, not written to it
+                data = d.read()
+
+        if password != "":
+            data = decrypt_state(data, password)
+        return data
+
+
+def save_document(remote, data, password):
+    with metrics.phase("state_save"):
+        if password != "":
+            data = encrypt_state(data, password)
 
-def load_state(url, password):
-    with pipe() as p:
         with tempfile.NamedTemporaryFile(prefix="river-c-") as f:
-            if password != "":
-                download(url + "/index.yaml", p).pipe(Proc.sink("/dev/null")) \
-                    .par(Proc.source(p)
-                         .pipe(Proc(["openssl", "aes-256-cbc", "-a", "-d", "-md", "sha256", "-pbkdf2", "-k", password],
-                                    "state decryption failed, invalid password?"))
-                         ).run(f)
-            else:
-                download(url + "/index.yaml", p).pipe(Proc.sink("/dev/null")) \
-                    .par(Proc.source(p)).run(f)
-            f.seek(0)
-            result = yaml.safe_load(f.read())
-            if "full_backups" not in result:
-                raise Exception("State is encrypted, password required")
-            return result
+            f.write(data)
+            f.flush()
+            upload(f.name, remote).run(stdout)
+
+
+def manifest_file(url, full_backup_name):
+    return full_remote_dir(url, full_backup_name) + "/manifest.yaml"
 
 
+# loads head of state, full backup manifests are loaded by load_manifest when needed
+# state saved before state_format 2 keeps everything in index.yaml, it is split on next save_state
+def load_state(url, password):
+    result = yaml.safe_load(load_document(url + "/index.yaml", password))
+    if not isinstance(result, dict) or "full_backups" not in result:
+        raise Exception("State is encrypted, password required")
+
+    loaded_manifests[url] = {}
+    if result.get("state_format", 1) < state_format:
+        for fb in result["full_backups"]:
+            loaded_manifests[url][fb["name"]] = None
+    return result
+
+
+# loads manifest of full backup from state into it, returns full backup
+def load_manifest(url, full_backup, password):
+    manifests = loaded_manifests.setdefault(url, {})
+    if full_backup["name"] in manifests:
+        return full_backup
+
+    if full_backup.get("manifest", False):
+        data = load_document(manifest_file(url, full_backup["name"]), password).decode("utf-8")
+        full_backup.update(yaml.safe_load(data))
+    else:
+        data = yaml.dump({})
+    manifests[full_backup["name"]] = data
+    return full_backup
+
+
+# saves manifests of loaded full backups if they changed, then head of state
 def save_state(url, state, password):
-    cfg = yaml.dump(state)
+    save_documents(state_documents(url, state), password)
+
+
+# documents to save state, [[remote file, data]], changed manifests first and head last
+# state is serialized at once, so documents can be saved in background while state changes further
+def state_documents(url, state):
+    manifests = loaded_manifests.setdefault(url, {})
+    documents = []
+    head = dict(state)
+    head["state_format"] = state_format
+    head["full_backups"] = []
+    for fb in state["full_backups"]:
+        if fb["name"] in manifests:
+            data = yaml.dump({k: v for k, v in fb.items() if k not in full_backup_head_keys})
+            if data != manifests[fb["name"]]:
+                documents.append([manifest_file(url, fb["name"]), data.encode("utf-8")])
+                manifests[fb["name"]] = data
+                fb["manifest"] = True
+        head["full_backups"].append({k: v for k, v in fb.items() if k in full_backup_head_keys})
+
+    documents.append([url + "/index.yaml", yaml.dump(head).encode("utf-8")])
+    return documents
 
-    with pipe() as p:
-        if password != "":
-            Proc.string_source(cfg) \
-                .pipe(Proc(["openssl", "aes-256-cbc", "-a", "-md", "sha256", "-pbkdf2", "-k", password])) \
-                .pipe(Proc.sink(p)) \
-                .par(upload(p, url + "/index.yaml")).run(stdout)
-        else:
-            Proc.string_source(cfg) \
-                .pipe(Proc.sink(p)) \
-                .par(upload(p, url + "/index.yaml")).run(stdout)
+
+def save_documents(documents, password):
+    for remote, data in documents:
+        save_document(remote, data, password)
+
+
+# copy of state that upload progress does not change, it only changes containers in state["upload"]
+# so state can be serialized and saved in thread while uploads go on
+def upload_snapshot(state):
+    snapshot = dict(state)
+    snapshot["upload"] = {k: v.copy() if isinstance(v, (list, dict)) else v for k, v in state["upload"].items()}
+    return snapshot
+
+
+def save_upload_snapshot(url, snapshot, password):
+    save_documents(state_documents(url, snapshot), password)
 
 
 def collect_options(local, password):
@@ -252,6 +1688,61 @@ def collect_options(local, password):
     return s
 
 
+# zpaq methods relative to method 1: rough compression speed and compressed size on mixed data
+# auto compression method estimates methods not measured yet by these
+compression_methods = range(6)
+method_priors = {0: [3.0, 2.5], 1: [1.0, 1.0], 2: [0.5, 0.9], 3: [0.2, 0.82], 4: [0.07, 0.7], 5: [0.02, 0.6]}
+compression_stats_weight = 0.5  # weight of last backup in moving averages of compression_stats
+compression_stats_min_bytes = 1024 * 1024  # smaller backups are too noisy to measure
+
+
+# zpaq method for next backup: configured one or, in auto mode, the one with shortest compression and upload time
+# per byte, by throughputs measured by previous backups
+def choose_compression_method(state):
+    method = config_value(state, "compression_method")
+    if method != "auto":
+        return method
+    stats = state.get("compression_stats", {})
+    measured = stats.get("methods", {})
+    if "upload_bps" not in stats or len(measured) == 0:
+        return optional_config["compression_method"][1]
+
+    def estimate(m):
+        if m in measured:
+            return measured[m]["input_bps"], measured[m]["ratio"]
+        base = min(measured, key=lambda k: abs(k - m))  # nearest measured method is most alike
+        return measured[base]["input_bps"] * method_priors[m][0] / method_priors[base][0], \
+            measured[base]["ratio"] * method_priors[m][1] / method_priors[base][1]
+
+    def seconds_per_byte(m):
+        speed, ratio = estimate(m)
+        if config_value(state, "stream_upload"):  # upload overlaps compression
+            return max(1.0 / speed, ratio / stats["upload_bps"])
+        return 1.0 / speed + ratio / stats["upload_bps"]
+
+    return min(compression_methods, key=seconds_per_byte)
+
+
+def moving_average(old, new):
+    return new if old is None else old + (new - old) * compression_stats_weight
+
+
+# updates compression_stats of state by compression and upload counted in `backup` metrics of the backup,
+# compression throughput is of all zpaq runs together
+def record_compression_stats(state, method, backup, parallel_uploads):
+    stats = state.setdefault("compression_stats", {})
+    input_bytes, output_bytes, seconds, runs = backup.compression
+    if method is not None and input_bytes >= compression_stats_min_bytes and seconds > 0:
+        m = stats.setdefault("methods", {}).setdefault(method, {})
+        m["input_bps"] = moving_average(m.get("input_bps"), input_bytes * runs / seconds)
+        m["ratio"] = moving_average(m.get("ratio"), output_bytes / input_bytes)
+
+    calls, seconds, size = backup.drivers.get("upload", [0, 0.0, 0])[:3]
+    if size >= compression_stats_min_bytes and seconds > 0:
+        # concurrent uploads share the link, so per-upload throughput is scaled by how many ran at once
+        stats["upload_bps"] = moving_average(stats.get("upload_bps"), size / seconds * min(calls, parallel_uploads))
+
+
 def delete_full_backup(url, full_backup_name):
     rp = full_remote_dir(url, full_backup_name)
     try:
@@ -268,15 +1759,27 @@ def new_full_backup_name():
     return n
 
 
-def roll_full_backup(url, state, password):
+# expired full backups are deleted by task spawned into background group, while backup goes on
+async def roll_full_backup(url, state, password, background):
 
     def start_new_full_backup():
         nm = new_full_backup_name()
-        state["full_backups"].append({
+        full_backup = {
             "name": nm,
             "index_version": "",
             "incremental_backups": []
-        })
+        }
+        if len(state["full_backups"]) > 0:
+            previous = state["full_backups"][-1]
+            depth = previous.get("synthetic_depth", 0)
+            if previous["index_version"] != "" and depth < config_value(state, "synthetic_full_backups") and \
+                    config_value(state, "shards") == 1:
+                full_backup["seed_from"] = previous["name"]
+                full_backup["synthetic_depth"] = depth + 1
+        if config_value(state, "shards") > 1:
+            full_backup["shards"] = [{"name": shard_name(nm, k), "index_version": "", "entries": []}
+                                     for k in range(config_value(state, "shards"))]
+        state["full_backups"].append(full_backup)
 
     if len(state["full_backups"]) == 0:  # no backups at all? start new one!
         start_new_full_backup()
@@ -287,28 +1790,376 @@ def roll_full_backup(url, state, password):
         # need to do full backup
         start_new_full_backup()
 
+    current_full_backup = state["full_backups"][-1]
+    if "seed_from" in current_full_backup:
+        await in_thread(save_state, url, state, password)  # so interrupted seeding is resumed, not orphaned
+        with metrics.phase("seed_full_backup"):
+            await in_thread(seed_full_backup, url, state, current_full_backup, password)
+
     backups_to_delete = []
     while len(state["full_backups"]) > state["keep_full_backup_count"]:
         backups_to_delete.append(state["full_backups"][0]["name"])
         del state["full_backups"][0]
-    save_state(url, state, password)
+    await in_thread(save_state, url, state, password)
+    background.spawn(delete_full_backups(url, backups_to_delete))
+
 
-    for name in backups_to_delete:
-        delete_full_backup(url, name)
+async def delete_full_backups(url, names):
+    with metrics.phase("delete_full_backups"):
+        await run_all([in_thread(delete_full_backup, url, name) for name in names])
+
+
+# synthetic full backup: new chain starts as copy of previous chain, tomes and index, so next zpaq run
+# only adds files changed since. Tomes are copied by driver copy operation if available, otherwise
+# uploaded from tome cache or downloaded and uploaded again. zpaq versions continue from previous chain,
+# base_version is added to incremental backup numbers of this chain
+def seed_full_backup(url, state, full_backup, password):
+    previous = None
+    for fb in state["full_backups"]:
+        if fb["name"] == full_backup["seed_from"]:
+            previous = load_manifest(url, fb, password)
+    load_manifest(url, full_backup, password)
+    if previous is None or previous["index_version"] == "" or "shards" in previous:
+        del full_backup["seed_from"]
+        return
+
+    src = full_remote_dir(url, previous["name"])
+    dst = full_remote_dir(url, full_backup["name"])
+    tmp_dir = full_local_dir(url) + "/seed"
+    copy = has_remote_copy(parse_url(url).protocol)
+    versions = previous.get("base_version", 0) + len(previous["incremental_backups"])
+
+    def copy_object(name):
+        if copy:
+            remote_copy(src + "/" + name, dst + "/" + name).run(stdout)
+            return
+        cached = cached_tome(url, previous, name)
+        tmp = tmp_dir + "/" + name
+        if cache_size > 0:
+            with CacheLock():  # linked out of cache, so it is not evicted while uploaded
+                if is_cached_tome_valid(cached, previous, name):
+                    link_or_copy(cached, tmp)
+        try:
+            if not os.path.exists(tmp):
+                download(src + "/" + name, tmp).run(stdout)
+            upload(tmp, dst + "/" + name).run(stdout)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    names = ["a00000.zpaq." + previous["index_version"]]
+    for i in range(1, versions + 1):
+        objects = tome_objects(src, previous, tome_name(i))
+        names += [tome_name(i)] if objects is None else [os.path.basename(o[0]) for o in objects]
+
+    shutil.rmtree(tmp_dir, True)
+    os.makedirs(tmp_dir)
+    try:
+        run_parallel([functools.partial(copy_object, n) for n in names], config_value(state, "parallel_uploads"))
+    finally:
+        shutil.rmtree(tmp_dir, True)
+
+    full_backup["index_version"] = previous["index_version"]
+    for k in ["index_size", "index_sha256"]:
+        if k in previous:
+            full_backup[k] = previous[k]
+    full_backup["tomes"] = dict(previous.get("tomes", {}))
+    full_backup["base_version"] = versions
+    del full_backup["seed_from"]
+
+
+# full backup with shards keeps one chain per shard, each with its own index and tomes, in shard-K subdirectory
+# of full backup. Full backup without shards is its own only chain
+def backup_chains(full_backup):
+    return full_backup.get("shards", [full_backup])
+
+
+def shard_name(full_backup_name, k):
+    return full_backup_name + "/shard-" + str(k)
+
+
+# path of chain files relative to full backup directory, "" or "shard-K/"
+def chain_prefix(full_backup, chain):
+    return "" if chain is full_backup else os.path.basename(chain["name"]) + "/"
+
+
+# splits paths to compress between shards by top-level entry of backup directory they are under
+# entry stays in its shard, new entries go to shard with least data so far
+# backup directory itself stands for all its entries, including recorded ones that are gone, so zpaq marks
+# them deleted
+# returns [paths per shard, entries per shard to record on commit]
+def shard_paths(shards, dirs, paths):
+    roots = [d.rstrip("/") or "/" for d in dirs]
+    current = []
+    for d in roots:
+        if os.path.isdir(d) and not os.path.islink(d):
+            current += [d.rstrip("/") + "/" + e for e in sorted(os.listdir(d))]
+        else:
+            current.append(d)
+
+    owner = {}
+    for k, shard in enumerate(shards):
+        for e in shard.get("entries", []):
+            owner[e] = k
+    sizes = [sum(t["size"] for t in shard.get("tomes", {}).values()) for shard in shards]
+    counts = [len(shard.get("entries", [])) for shard in shards]
+
+    def owner_of(e):
+        if e not in owner:
+            k = min(range(len(shards)), key=lambda n: (sizes[n], counts[n]))
+            owner[e] = k
+            counts[k] += 1
+        return owner[e]
+
+    result = [[] for _ in shards]
+    for p in paths:
+        p = p.rstrip("/") or "/"
+        root = None
+        for d in roots:
+            if is_under(p, d):
+                root = d
+                break
+        if root is None:
+            result[0].append(p)
+        elif p == root:
+            for e in sorted(set(current) | set(owner)):
+                if is_under(e, root):
+                    result[owner_of(e)].append(e)
+        else:
+            rel = os.path.relpath(p, root)
+            result[owner_of(root.rstrip("/") + "/" + rel.split("/")[0])].append(p)
+
+    entries = [[e for e in current if owner_of(e) == k] for k in range(len(shards))]
+    return [sorted(set(r)) for r in result], entries
+
+
+# merges tome segments yielded by stream_compress of several chains, prefixing them with chain_prefix
+async def merge_streams(streams):
+    streams = list(streams)
+    try:
+        while len(streams) > 0:
+            ready = False
+            for s in list(streams):
+                try:
+                    unit = await s[1].__anext__()
+                except StopAsyncIteration:
+                    streams.remove(s)
+                    continue
+                if unit is not None:
+                    ready = True
+                    yield s[0] + unit
+            if not ready:
+                yield None
+    finally:
+        for s in streams:
+            await s[1].aclose()
+
+
+# upload files from local_dir to remote_dir using up to `threads` concurrent uploads
+# files may be a list or an async iterator, yielding None while next file is not ready for upload yet
+# make_upload(f), if set, creates upload for file f, default is plain upload of local_dir/f
+# on_uploaded(f) is called on event loop after each successful upload, or on_uploaded(f, digest(f)) if digest is set,
+# digest is called in thread, so it may read the file
+# on failure, uploads in flight are awaited, pending ones are not started and first error is re-raised
+async def upload_files(local_dir, remote_dir, files, threads, on_uploaded, make_upload=None, digest=None):
+    if make_upload is None:
+        def make_upload(f):
+            return upload(local_dir + "/" + f, remote_dir + "/" + f)
+
+    async def upload_file(f):
+        await make_upload(f).run_async(stdout)
+        if digest is not None:
+            return [f, await in_thread(digest, f)]
+        return [f]
+
+    if not hasattr(files, "__anext__"):
+        files = list_stream(files)
+    running = {}
+    error = None
+    has_more = True
+
+    try:
+        while True:
+            ready = True
+            while has_more and error is None and len(running) < max(1, threads):
+                try:
+                    f = await files.__anext__()
+                except StopAsyncIteration:
+                    has_more = False
+                    break
+                if f is None:
+                    ready = False
+                    break
+                running[asyncio.ensure_future(upload_file(f))] = f
+
+            if len(running) == 0:
+                if not has_more or error is not None:
+                    break
+                await asyncio.sleep(0.1)
+                continue
+
+            done, _ = await asyncio.wait(running.keys(), timeout=None if ready else 0.1,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                f = running.pop(task)
+                if error is not None:
+                    continue
+                try:
+                    on_uploaded(*task.result())
+                except Exception as e:
+                    error = e
+    finally:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running.keys(), return_exceptions=True)
+        await files.aclose()
+
+    if error is not None:
+        raise error
+
+
+async def list_stream(files):
+    for f in files:
+        yield f
+
+
+# local append-only log of files uploaded since last remote state save
+# it lives in local backup dir, so it is valid exactly as long as files it refers to
+# every line is file name and its sha256, tab-separated
+def append_upload_journal(local_dir, f, sha256):
+    with open(local_dir + "/" + upload_journal_file, "a") as j:
+        j.write(f + "\t" + sha256 + "\n")
+        j.flush()
+        os.fsync(j.fileno())
+
+
+# [[file name, sha256]]
+def read_upload_journal(local_dir):
+    try:
+        with open(local_dir + "/" + upload_journal_file) as j:
+            return [(l.split("\t") + [None])[:2] for l in j.read().split("\n") if l != ""]
+    except IOError:
+        return []
+
+
+def file_sha256(fname, offset=0, length=None):
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        f.seek(offset)
+        while length is None or length > 0:
+            buf = f.read(1024 * 1024 if length is None else min(length, 1024 * 1024))
+            if len(buf) == 0:
+                break
+            h.update(buf)
+            if length is not None:
+                length -= len(buf)
+    return h.hexdigest()
+
+
+# sha256 of upload unit, whole file or its segment
+def unit_sha256(local_dir, unit, segment_size):
+    f, n = parse_segment(unit)
+    if n is None:
+        return file_sha256(local_dir + "/" + f)
+    return file_sha256(local_dir + "/" + f, n * segment_size, segment_size)
+
+
+# full_backups[].tomes[name].size            tome size in bytes
+# full_backups[].tomes[name].sha256          sha256 of tome, if uploaded as whole
+# full_backups[].tomes[name].segments        number of segments tome is uploaded in, 0 if uploaded as whole
+# full_backups[].tomes[name].segment_size    size of segments
+# full_backups[].tomes[name].segment_sha256  sha256 of every segment
+# full_backups[].tomes[name].head            base64 of first bytes of first tome, lets zpaq open the chain without it
+def record_tomes(full_backup, local_dir, units, segment_size, hashes):
+    if "tomes" not in full_backup:
+        full_backup["tomes"] = {}
+    segments = {}
+    for unit in units:
+        f, n = parse_segment(unit)
+        if f not in segments:
+            segments[f] = []
+        if n is not None:
+            segments[f].append(unit)
+    for f in segments:
+        tome = {"size": os.path.getsize(local_dir + "/" + f), "segments": len(segments[f])}
+        if len(segments[f]) == 0:
+            if f in hashes:
+                tome["sha256"] = hashes[f]
+        else:
+            tome["segment_size"] = segment_size
+            if all(u in hashes for u in segments[f]):
+                tome["segment_sha256"] = [hashes[u] for u in sorted(segments[f], key=lambda u: parse_segment(u)[1])]
+        if f == first_tome:
+            with open(local_dir + "/" + f, "rb") as t:
+                tome["head"] = base64.b64encode(t.read(tome_head_size)).decode("ascii")
+        full_backup["tomes"][f] = tome
+
+
+# download tome uploaded by perform_backup
+# if it was uploaded in segments, up to `threads` segments are downloaded at once and written to their place in dst
+def download_tome(base, full_backup, name, dst, threads=1):
+    tome = full_backup.get("tomes", {}).get(name, {})
+    if tome.get("segments", 0) == 0:
+        download(base + "/" + name, dst).run(stdout)
+        return
+
+    def download_segment(n):
+        part = segment_name(dst, n)
+        try:
+            download(base + "/" + segment_name(name, n), part).run(stdout)
+            with open(part, "rb") as f, open(dst, "r+b") as out:
+                out.seek(n * tome["segment_size"])
+                shutil.copyfileobj(f, out)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+
+    with open(dst, "wb"):
+        pass
+    run_parallel([functools.partial(download_segment, n) for n in range(tome["segments"])], threads)
 
 
 def perform_backup(url, dirs, password):
-    state = load_state(url, password)
-    roll_full_backup(url, state, password)
+    with UrlLock(url):
+        run_async(perform_locked_backup(url, dirs, password))
+
+
+# steps run on event loop, independent ones concurrently: deletion of expired full backups goes on in background,
+# index transfers and compression of chains run at once, state is saved while next uploads go on, old indexes
+# are deleted while local files are cleaned up
+async def perform_locked_backup(url, dirs, password):
+    background = TaskGroup()
+    try:
+        await backup_locked(url, dirs, password, background)
+    finally:
+        await background.wait()
 
-    current_full_backup = state["full_backups"][-1]
+
+async def backup_locked(url, dirs, password, background):
+    state = await in_thread(load_state, url, password)
+    with metrics.phase("roll_full_backup"):
+        await roll_full_backup(url, state, password, background)
+
+    current_full_backup = await in_thread(load_manifest, url, state["full_backups"][-1], password)
+    chains = backup_chains(current_full_backup)
 
     full_remote = full_remote_dir(url, current_full_backup["name"])
     local_dir = full_local_dir(url)
     index_file = "a00000.zpaq"
 
-    def remote_index(version):
-        return full_remote + "/" + index_file + "." + version
+    # files of chain, relative to full backup directory, local and remote
+    def chain_file(chain, f):
+        return chain_prefix(current_full_backup, chain) + f
+
+    def remote_index(chain, version):
+        return full_remote + "/" + chain_file(chain, index_file) + "." + version
+
+    async def download_index(chain):
+        await download(remote_index(chain, chain["index_version"]),
+                       local_dir + "/" + chain_file(chain, index_file)).run_async(stdout)
+
+    async def upload_index(chain, version):
+        await upload(local_dir + "/" + chain_file(chain, index_file), remote_index(chain, version)).run_async(stdout)
 
     def clean_local_dir():
         shutil.rmtree(local_dir, True)
@@ -320,6 +2171,15 @@ def perform_backup(url, dirs, password):
                 return False
         return True
 
+    # apply uploads recorded locally but not yet saved to remote state
+    if "upload" in state and "files_left" in state["upload"] and "files_uploaded" in state["upload"]:
+        for f, sha256 in read_upload_journal(local_dir):
+            if f in state["upload"]["files_left"]:
+                state["upload"]["files_left"].remove(f)
+                state["upload"]["files_uploaded"].append(f)
+                if sha256 is not None:
+                    state["upload"].setdefault("hashes", {})[f] = sha256
+
     # we have pending upload if:
     # - uploaded and pending files are still there
     # - index file is still there
@@ -330,42 +2190,152 @@ def perform_backup(url, dirs, password):
         and len(state["upload"]["files_left"]) > 0 \
         and os.path.isdir(local_dir) \
         and len(state["upload"]["files_left"]) \
-        and os.path.isfile(local_dir + "/" + index_file) \
-        and forall(lambda ff: os.path.isfile(local_dir + "/" + ff), state["upload"]["files_left"]) \
-        and forall(lambda ff: os.path.isfile(local_dir + "/" + ff), state["upload"]["files_uploaded"])
+        and forall(lambda c: os.path.isfile(local_dir + "/" + chain_file(c, index_file)), chains) \
+        and forall(lambda ff: os.path.isfile(local_dir + "/" + parse_segment(ff)[0]), state["upload"]["files_left"]) \
+        and forall(lambda ff: os.path.isfile(local_dir + "/" + parse_segment(ff)[0]), state["upload"]["files_uploaded"])
+
+    threads = config_value(state, "parallel_uploads")
 
+    backup = Metrics()
+    backup_metrics.set(backup)  # inherited by tasks and threads started by backup from here on
+    method = None
     if not is_upload_in_progress:
         clean_local_dir()
+        for c in chains:
+            os.makedirs(local_dir + "/" + chain_file(c, ""), exist_ok=True)
         if current_full_backup["index_version"] != "":
-            download(remote_index(current_full_backup["index_version"]), local_dir + "/" + index_file).run(stdout)
-        compress(local_dir, dirs + collect_options(state["local"], password))
-        files = list(filter(lambda f: os.path.isfile(local_dir + "/" + f) and f != index_file, os.listdir(local_dir)))
-        state["upload"] = {"files_uploaded": [], "files_left": list(files)}
-    else:
-        files = state["upload"]["files_left"]
-
-    save_state(url, state, password)
-    for f in files:
-        upload(local_dir + "/" + f, full_remote + "/" + f).run(stdout)
-        state["upload"]["files_left"].remove(f)
-        state["upload"]["files_uploaded"].append(f)
-        save_state(url, state, password)
+            with metrics.phase("index_download"):
+                await run_all([download_index(c) for c in chains], threads)
+        paths = changed_paths(url, dirs, take_change_journal(url))
+        if paths is None or current_full_backup["index_version"] == "":
+            paths = dirs
+        entries = None
+        if "shards" in current_full_backup:
+            chain_paths, entries = shard_paths(current_full_backup["shards"], dirs, paths)
+        else:
+            chain_paths = [paths]
+        # nothing changed in chain, zpaq still needs a path to write empty version, keeping versions in step
+        # with backups
+        chain_paths = [p if len(p) > 0 else [dirs[0].rstrip("/") + "/.river-unchanged"] for p in chain_paths]
+        method = choose_compression_method(state)
+        options = collect_options(state["local"], password) + ["-method", str(method)]
+        compression_threads = config_value(state, "compression_threads")
+        if compression_threads == 0 and len(chains) > 1:  # shards compress in parallel, cores are split between them
+            compression_threads = max(1, (os.cpu_count() or 1) // len(chains))
+        if compression_threads > 0:
+            options += ["-threads", str(compression_threads)]
+        streamed = []
+        hashes = {}
+        segment_size = config_value(state, "segment_size") * 1024 * 1024
+        if config_value(state, "stream_upload"):
+            # upload tome segments while zpaq is still writing them
+            if segment_size == 0:
+                segment_size = stream_segment_size
+
+            def streamed_sha256(unit):
+                return unit_sha256(local_dir, unit, segment_size)
+
+            def on_streamed(unit, sha256):
+                streamed.append(unit)
+                hashes[unit] = sha256
+                f, n = parse_segment(unit)
+                punch_hole(local_dir + "/" + f, n * segment_size, segment_size)
+
+            streams = [[chain_file(c, ""), stream_compress(local_dir + "/" + chain_file(c, ""), p + options,
+                                                           segment_size)] for c, p in zip(chains, chain_paths)]
+            with metrics.phase("compress_and_upload"):
+                await upload_files(local_dir, full_remote, merge_streams(streams), threads,
+                                   on_streamed, lambda unit: SegmentUpload(local_dir, full_remote, unit, segment_size),
+                                   streamed_sha256)
+        else:
+            with metrics.phase("compress"):
+                await run_all([compress(local_dir + "/" + chain_file(c, ""), p + options)
+                               for c, p in zip(chains, chain_paths)])
+        files = []
+        for c in chains:
+            files += [chain_file(c, f) for f in os.listdir(local_dir + "/" + chain_file(c, ""))
+                      if os.path.isfile(local_dir + "/" + chain_file(c, f)) and f != index_file and
+                      f != upload_journal_file]
+        units = upload_units(local_dir, files, segment_size)
+        state["upload"] = {
+            "files_uploaded": [u for u in units if u in streamed],
+            "files_left": [u for u in units if u not in streamed],
+            "segment_size": segment_size,
+            "hashes": hashes
+        }
+        if entries is not None:
+            state["upload"]["shard_entries"] = entries
+    files = list(state["upload"]["files_left"])
+    segment_size = state["upload"].get("segment_size", 0)
+
+    await in_thread(save_state, url, state, password)
+    last_save = [time.time()]
+    saving = [None]
+
+    # progress goes to local journal after every file and to remote state once in a while, saved in background
+    # while next uploads go on; remote state is always saved on commit below
+    # runs in thread, so uploads go on while unit is read and journal is synced
+    def journal_upload(unit):
+        sha256 = unit_sha256(local_dir, unit, segment_size)
+        append_upload_journal(local_dir, unit, sha256)
+        return sha256
+
+    def on_uploaded(unit, sha256):
+        state["upload"]["files_left"].remove(unit)
+        state["upload"]["files_uploaded"].append(unit)
+        state["upload"].setdefault("hashes", {})[unit] = sha256
+        f, n = parse_segment(unit)
+        if n is not None and n > 0:  # first segment is kept for record_tomes
+            punch_hole(local_dir + "/" + f, n * segment_size, segment_size)
+        if time.time() - last_save[0] >= state_save_interval and (saving[0] is None or saving[0].done()):
+            if saving[0] is not None:
+                saving[0].result()  # failed save fails the upload
+            saving[0] = asyncio.ensure_future(in_thread(save_upload_snapshot, url, upload_snapshot(state), password))
+            last_save[0] = time.time()
+
+    def make_upload(unit):
+        if parse_segment(unit)[1] is None:
+            return upload(local_dir + "/" + unit, full_remote + "/" + unit)
+        return SegmentUpload(local_dir, full_remote, unit, segment_size)
+
+    with metrics.phase("upload"):
+        try:
+            await upload_files(local_dir, full_remote, files, threads, on_uploaded, make_upload, journal_upload)
+        finally:
+            if saving[0] is not None:
+                await saving[0]
+    for c in chains:
+        prefix = chain_file(c, "")
+        record_tomes(c, local_dir + "/" + prefix,
+                     [u[len(prefix):] for u in state["upload"]["files_uploaded"] if u.startswith(prefix)],
+                     segment_size, {u[len(prefix):]: h for u, h in state["upload"].get("hashes", {}).items()
+                                    if u.startswith(prefix)})
 
     index_version_old = current_full_backup["index_version"]
     index_version_new = str(time.time())
 
-    upload(local_dir + "/" + index_file, remote_index(index_version_new)).run(stdout)
+    with metrics.phase("index_upload"):
+        await run_all([upload_index(c, index_version_new) for c in chains], threads)
 
+    for c in chains:
+        c["index_version"] = index_version_new
+        c["index_size"] = os.path.getsize(local_dir + "/" + chain_file(c, index_file))
+        c["index_sha256"] = file_sha256(local_dir + "/" + chain_file(c, index_file))
     current_full_backup["index_version"] = index_version_new
+    for shard, entries in zip(current_full_backup.get("shards", []), state["upload"].get("shard_entries", [])):
+        shard["entries"] = entries
+
+    record_compression_stats(state, method, backup, threads)
 
     # totally commit
     state["last_backup_timestamp"] = int(time.time())
     current_full_backup["incremental_backups"].append(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-    save_state(url, state, password)
-
-    delete(remote_index(index_version_old)).pipe(Proc.sink("/dev/null")).run(stdout)
+    await in_thread(save_state, url, state, password)
+    discard_change_journal(url)
 
-    clean_local_dir()
+    with metrics.phase("index_delete"):
+        await run_all([delete(remote_index(c, index_version_old)).run_async(stdout) for c in chains] +
+                      [in_thread(clean_local_dir)])
 
 
 # [].version
@@ -383,17 +2353,354 @@ def restore_urls(state):
     return r
 
 
-# restore backup by backup URL and version
-# please note that archive keep absolute file names and extraction will work in the same way
-# if you want to extract to somewhere else, use second parameter
-def restore(url, version, password, to="", verify=False):
+# local cache of downloaded tomes, shared by all commands reading tomes
+# tomes never change once uploaded, so cache entry is valid as long as its size matches recorded one
+# cache_dir/<url>/<full backup name>/<tome>, least recently used entries are evicted above cache_size
+cache_size = int(os.getenv("river_cache_size", "0")) * 1024 * 1024  # 0 disables cache
+cache_dir = os.getenv("river_cache_dir", "")  # default is work_dir/cache
+cache_lock = threading.Lock()
+cache_lock_file = ".lock"
+
+
+def tome_cache_dir():
+    return cache_dir if cache_dir != "" else work_dir + "/cache"
+
+
+# exclusive lock on tome cache, for threads of this command and for other river processes sharing the cache
+class CacheLock:
+
+    def __enter__(self):
+        cache_lock.acquire()
+        try:
+            os.makedirs(tome_cache_dir(), exist_ok=True)
+            self.f = open(tome_cache_dir() + "/" + cache_lock_file, "w")
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+        except BaseException:
+            cache_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        cache_lock.release()
+
+
+def cached_tome(url, full_backup, name):
+    return tome_cache_dir() + "/" + re.sub(r'\W', ".", url) + "/" + full_backup["name"] + "/" + name
+
+
+def is_cached_tome_valid(fname, full_backup, name):
+    if not os.path.isfile(fname):
+        return False
+    tome = full_backup.get("tomes", {}).get(name)
+    return tome is None or os.path.getsize(fname) == tome["size"]
+
+
+cache_tmp_re = re.compile(r"\.tmp\d+-\d+(\.s\d+)?$")
+
+
+# called under CacheLock, so entries of other threads and processes are not evicted between their download and link
+def evict_cached_tomes(keep):
+    entries = []
+    total = 0
+    for root, _, files in os.walk(tome_cache_dir()):
+        for f in files:
+            if cache_tmp_re.search(f):  # download in progress, its segment parts too
+                continue
+            if root == tome_cache_dir() and f == cache_lock_file:
+                continue
+            p = root + "/" + f
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            entries.append([st.st_mtime, st.st_size, p])
+            total += st.st_size
+
+    for mtime, size, p in sorted(entries):
+        if total <= cache_size:
+            break
+        if p == keep:
+            continue
+        try:
+            os.remove(p)
+            total -= size
+        except OSError:
+            pass
+
+
+# copy of local file, hard link if possible
+def link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+# download tome or index of full backup to dst, through tome cache if it is enabled
+def fetch_tome(url, base, full_backup, name, dst, threads=1):
+    if cache_size == 0:
+        download_tome(base, full_backup, name, dst, threads)
+        return
+
+    entry = cached_tome(url, full_backup, name)
+    with CacheLock():
+        if is_cached_tome_valid(entry, full_backup, name):
+            os.utime(entry)
+            link_or_copy(entry, dst)
+            return
+
+    tmp = entry + ".tmp" + str(os.getpid()) + "-" + str(threading.get_ident())
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    try:
+        download_tome(base, full_backup, name, tmp, threads)
+        with CacheLock():
+            os.replace(tmp, entry)
+            link_or_copy(entry, dst)
+            evict_cached_tomes(entry)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# run blocking callables using up to `threads` threads, from code outside of event loop
+# on failure, pending ones are cancelled and first error is re-raised
+def run_parallel(tasks, threads):
+    run_async(run_all([in_thread(t) for t in tasks], threads))
+
+
+# fail before downloading if tomes of known size do not fit into local disk or restore disk budget
+# chain_tomes is [[full backup or its shard, tomes]], tomes already in cache are not counted
+def check_disk_budget(url, local_dir, chain_tomes):
+    needed = 0
+    for full_backup, tomes in chain_tomes:
+        for t in tomes:
+            if t not in full_backup.get("tomes", {}):
+                continue
+            if cache_size > 0 and is_cached_tome_valid(cached_tome(url, full_backup, t), full_backup, t):
+                continue
+            needed += full_backup["tomes"][t]["size"]
+
+    os.makedirs(local_dir, exist_ok=True)
+    available = shutil.disk_usage(local_dir).free
+    if restore_disk_budget > 0:
+        available = min(available, restore_disk_budget)
+    if needed > available:
+        raise Exception("Restore needs " + str(needed) + " bytes of local disk in " + local_dir +
+                        ", only " + str(available) + " bytes available")
+
+
+def tome_name(n):
+    return "a" + str(n).zfill(5) + ".zpaq"
+
+
+# zpaq list output of index, -summary -1 adds fragment ids to every line
+def list_index(index, v, password, all_versions=False):
+    zpaq_command = [get_script_dir() + "/zpaq", "list", index, "-until", v, "-summary", "-1"]
+    if all_versions:
+        zpaq_command += ["-all"]
+    if password != "":
+        zpaq_command += ["-key", password]
+    return zpaq_output(zpaq_command)
+
+
+def zpaq_output(zpaq_command):
+    with tempfile.NamedTemporaryFile(prefix="river-c-") as f, tempfile.NamedTemporaryFile(prefix="river-c-") as e:
+        try:
+            Proc(zpaq_command, "zpaq invocation failed").run(f, e)
+        except IOError:
+            e.seek(0)
+            sys.stderr.write(e.read().decode('utf-8'))
+            raise
+        f.seek(0)
+        return f.read().decode("utf-8", "replace").split("\n")
+
+
+list_line_re = re.compile(r"^- (\S+ \S+) +(\d+) (.{5}) (.*?)((?: \d+(?:-\d+)?)*)$")
+
+
+def parse_fragments(s):
+    ids = []
+    for r in s.split():
+        bounds = r.split("-")
+        ids += list(range(int(bounds[0]), int(bounds[-1]) + 1))
+    return ids
+
+
+# files of archive at version v: name -> [size, fragment ids], directories are skipped
+def index_files(index, v, password):
+    files = {}
+    for line in list_index(index, v, password):
+        m = list_line_re.match(line)
+        if m is not None and not m.group(3).startswith("d"):
+            files[m.group(4)] = [int(m.group(2)), parse_fragments(m.group(5))]
+    return files
+
+
+# entries of archive at version v: name -> [mtime, size, attributes], directory names end with /
+def index_entries(index, v, password):
+    entries = {}
+    for line in list_index(index, v, password):
+        m = list_line_re.match(line)
+        if m is not None:
+            entries[m.group(4)] = [calendar.timegm(time.strptime(m.group(1), "%Y-%m-%d %H:%M:%S")),
+                                   int(m.group(2)), m.group(3)]
+    return entries
+
+
+# local path zpaq extracts archived name to
+def restore_target(to, name):
+    return name if to == "" else to.rstrip("/") + "/" + name.lstrip("/")
+
+
+# archived entries not under other archived directories
+def top_entries(entries):
+    return sorted(n for n in entries if os.path.dirname(n.rstrip("/")) + "/" not in entries)
+
+
+compare_line_re = re.compile(r"^# \S+ \S+ +\d+ .{5} (.*)$")
+
+
+# names of files of version v whose content differs from files in place, compared by zpaq by fragment hashes
+def content_changes(index, v, password, entries):
+    zpaq_command = [get_script_dir() + "/zpaq", "list", index] + [n.rstrip("/") for n in top_entries(entries)] + \
+                   ["-until", v, "-force", "-not", "="]
+    if password != "":
+        zpaq_command += ["-key", password]
+    changed = set()
+    for line in zpaq_output(zpaq_command):
+        m = compare_line_re.match(line)
+        if m is not None and not m.group(1).endswith("/"):
+            changed.add(m.group(1))
+    return changed
+
+
+# names to extract so target matches archived entries: missing ones and files differing by size, mtime or
+# permissions, or, if `changed` is set, ones in it. Missing directory is returned instead of its content
+# returns [names, target entries of other type than archived one], latter are to be removed by remove_conflicts
+# right before extraction, so zpaq can extract over them
+def delta_entries(entries, to, changed=None):
+    result = []
+    conflicts = []
+    missing_dir = None
+    for name in sorted(entries):
+        if missing_dir is not None and name.startswith(missing_dir):
+            continue
+        mtime, size, attr = entries[name]
+        local = restore_target(to, name.rstrip("/"))
+        try:
+            st = os.lstat(local)
+        except FileNotFoundError:
+            st = None
+        is_dir = name.endswith("/")
+        if st is not None and (os.path.isdir(local) and not os.path.islink(local)) != is_dir:
+            conflicts.append(local)
+            st = None
+
+        if st is None:
+            result.append(name.rstrip("/"))
+            if is_dir:
+                missing_dir = name
+        elif not is_dir:
+            mode_differs = re.match(r"^ [0-7]{4}$", attr) is not None and st.st_mode & 0o7777 != int(attr, 8)
+            if changed is not None:
+                differs = name in changed
+            else:
+                differs = st.st_size != size or int(st.st_mtime) != mtime
+            if differs or mode_differs:
+                result.append(name)
+    return result, conflicts
+
+
+def remove_conflicts(conflicts):
+    for local in conflicts:
+        if os.path.isdir(local) and not os.path.islink(local):
+            shutil.rmtree(local)
+        elif os.path.lexists(local):
+            os.remove(local)
+
+
+# deletes everything under roots of target that is not among archived entries and matches patterns, if set
+def delete_extra_files(entries, roots, to, patterns):
+    names = set(n.rstrip("/") for n in entries)
+    for root in roots:
+        local_root = restore_target(to, root)
+        for d, dirs, files in os.walk(local_root):
+            name_dir = root + d[len(local_root):]
+            for f in dirs + files:
+                name = name_dir.rstrip("/") + "/" + f
+                if name in names or (patterns is not None and not path_matches(name, patterns)):
+                    continue
+                local = d + "/" + f
+                if os.path.isdir(local) and not os.path.islink(local):
+                    shutil.rmtree(local)
+                    dirs.remove(f)
+                else:
+                    os.remove(local)
+
+
+# fragment id -> archive version (tome number) which added it
+def fragment_versions(index, v, password):
+    versions = {}
+    for line in list_index(index, v, password, True):
+        m = list_line_re.match(line)
+        if m is None:
+            continue
+        vm = re.match(r"^(\d+)/ \+\d+ -\d+ -> \d+((?: \d+(?:-\d+)?)*)$", m.group(4) + m.group(5))
+        if vm is not None:
+            for frag in parse_fragments(vm.group(2)):
+                versions[frag] = int(vm.group(1))
+    return versions
+
+
+# same matching as zpaq -only: pattern matches file itself or any of its directories, * and ? are wildcards
+def path_matches(name, patterns):
+    parts = name.rstrip("/").split("/")
+    for p in patterns:
+        p = p.rstrip("/").replace("[", "[[]")
+        for i in range(1, len(parts) + 1):
+            if fnmatch.fnmatchcase("/".join(parts[:i]), p):
+                return True
+    return False
+
+
+# tomes holding data of files matching patterns at version v
+def tomes_for_paths(index, v, password, patterns):
+    versions = fragment_versions(index, v, password)
+    needed = set()
+    for name, [size, frags] in index_files(index, v, password).items():
+        if path_matches(name, patterns):
+            for frag in frags:
+                needed.add(versions[frag])
+    return needed
+
+
+# stand-in for tome that is not needed for extraction: sparse file of the same size
+# zpaq reads beginning of the first tome even if no data is extracted from it
+def make_tome_placeholder(full_backup, name, dst):
+    tome = full_backup["tomes"][name]
+    with open(dst, "wb") as f:
+        if "head" in tome:
+            f.write(base64.b64decode(tome["head"]))
+        f.truncate(tome["size"])
+
+
+def can_skip_tome(full_backup, name):
+    tome = full_backup.get("tomes", {}).get(name)
+    return tome is not None and (name != first_tome or "head" in tome)
+
+
+# state, full backup, its remote dir and incremental backup number of version returned by restore_urls
+def load_version(url, version, password):
     parts = version.split(":")
     if len(parts) != 2:
         raise Exception("Incorrect version: " + version)
     name = parts[0]
     v = parts[1]
-    base = full_remote_dir(url, name)
-    work_dir = full_local_dir(url) + "/restore"
 
     state = load_state(url, password)
 
@@ -405,31 +2712,254 @@ def restore(url, version, password, to="", verify=False):
     if current_full_backup is None:
         raise Exception("Full backup not found, invalid url?")
 
-    download(base + "/a00000.zpaq." + current_full_backup["index_version"], work_dir + "/a00000.zpaq").run(stdout)
-
-    # download archives
-    for i in range(1, int(v) + 1):
-        fname = "a" + str(i).zfill(5) + ".zpaq"
-        download(base + "/" + fname, work_dir + "/" + fname).run(stdout)
+    if not v.isdigit():
+        raise Exception("Incorrect version: " + version)
+    load_manifest(url, current_full_backup, password)
+    # synthetic full backup continues zpaq versions of chain it was seeded from
+    v = str(int(v) + current_full_backup.get("base_version", 0))
+    return state, current_full_backup, full_remote_dir(url, name), v
+
+
+# remote files of tome as recorded by record_tomes: [[remote file, size, sha256 or None]]
+# None if tome was uploaded without manifest
+def tome_objects(base, full_backup, name):
+    tome = full_backup.get("tomes", {}).get(name)
+    if tome is None:
+        return None
+    if tome["segments"] == 0:
+        return [[base + "/" + name, tome["size"], tome.get("sha256")]]
+
+    hashes = tome.get("segment_sha256", [None] * tome["segments"])
+    objects = []
+    for n in range(tome["segments"]):
+        size = max(0, min(tome["segment_size"], tome["size"] - n * tome["segment_size"]))
+        objects.append([base + "/" + segment_name(name, n), size, hashes[n]])
+    return objects
+
+
+# remote files of version: index and all tomes up to it, of every chain of full backup
+# returns [objects, names of tomes without manifest]
+def version_objects(url, full_backup, v):
+    objects = []
+    unknown = []
+    for chain in backup_chains(full_backup):
+        base = full_remote_dir(url, chain["name"])
+        if "index_size" in chain:
+            objects.append([base + "/a00000.zpaq." + chain["index_version"], chain["index_size"],
+                            chain.get("index_sha256")])
+        else:
+            unknown.append(chain_prefix(full_backup, chain) + "a00000.zpaq." + chain["index_version"])
 
-    # invoke zpaq
-    zpaq_command = [get_script_dir() + "/zpaq", "extract", work_dir + "/a?????.zpaq", "-until", v,
-                    "-force"]
-    if verify:
-        zpaq_command += ["-test"]
+        for i in range(1, int(v) + 1):
+            o = tome_objects(base, chain, tome_name(i))
+            if o is None:
+                unknown.append(chain_prefix(full_backup, chain) + tome_name(i))
+            else:
+                objects += o
+    return objects, unknown
 
-    if to != "":
-        zpaq_command += ["-to", to]
 
-    if password != "":
-        zpaq_command += ["-key", password]
+# check remote files against manifest without downloading them, by driver stat operation
+# sha256 is checked if driver provides it, returns list of problems found
+def verify_quick(url, version, password):
+    state, full_backup, base, v = load_version(url, version, password)
+    objects, unknown = version_objects(url, full_backup, v)
+    problems = []
 
-    with tempfile.NamedTemporaryFile(prefix="river-c-") as f:
+    def check(remote, size, sha256):
         try:
-            Proc(zpaq_command, "zpaq invocation failed").run(stdout, f)
-        except Exception:
-            f.seek(0)
-            sys.stderr.write(f.read())
+            remote_size, remote_sha256 = stat(remote)
+        except IOError as e:
+            problems.append(str(e))
+            return
+        if remote_size != size:
+            problems.append(remote + ": size is " + str(remote_size) + ", expected " + str(size))
+        elif sha256 is not None and remote_sha256 is not None and remote_sha256 != sha256:
+            problems.append(remote + ": sha256 is " + remote_sha256 + ", expected " + sha256)
+
+    with metrics.phase("verify"):
+        run_parallel([functools.partial(check, *o) for o in objects], config_value(state, "parallel_downloads"))
+    for u in unknown:
+        sys.stderr.write("warning: " + u + " has no manifest, not verified\n")
+    return problems
+
+
+# download index and `sample` randomly chosen tomes of version and check them against manifest
+# returns list of problems found
+def verify_sample(url, version, password, sample):
+    state, full_backup, base, v = load_version(url, version, password)
+    work_dir = full_local_dir(url) + "/verify"
+
+    tomes = []
+    objects = []
+    for chain in backup_chains(full_backup):
+        base = full_remote_dir(url, chain["name"])
+        tomes += [[base, chain, tome_name(i)] for i in range(1, int(v) + 1)
+                  if tome_objects(base, chain, tome_name(i)) is not None]
+        if "index_size" in chain:
+            objects.append([base + "/a00000.zpaq." + chain["index_version"], chain["index_size"],
+                            chain.get("index_sha256")])
+    for t in random.sample(tomes, min(sample, len(tomes))):
+        objects += tome_objects(*t)
+    problems = []
+
+    def check(remote, size, sha256):
+        local = work_dir + "/" + str(threading.get_ident()) + "-" + os.path.basename(remote)
+        try:
+            download(remote, local).run(stdout)
+        except IOError as e:
+            problems.append(str(e))
+            return
+        try:
+            if os.path.getsize(local) != size:
+                problems.append(remote + ": size is " + str(os.path.getsize(local)) + ", expected " + str(size))
+            elif sha256 is not None and file_sha256(local) != sha256:
+                problems.append(remote + ": sha256 does not match")
+        finally:
+            os.remove(local)
+
+    shutil.rmtree(work_dir, True)
+    os.makedirs(work_dir)
+    try:
+        with metrics.phase("verify"):
+            run_parallel([functools.partial(check, *o) for o in objects], config_value(state, "parallel_downloads"))
+    finally:
+        shutil.rmtree(work_dir, True)
+    return problems
+
+
+# restore backup by backup URL and version
+# please note that archive keep absolute file names and extraction will work in the same way
+# if you want to extract to somewhere else, use second parameter
+# if paths are set, only files matching these patterns are restored and only tomes holding them are downloaded
+# with delta, only files missing in target or differing from backup by size, mtime or permissions (by content,
+# compared by zpaq, with checksum) are restored; with delete_extra, files of restored directories that are not in
+# the backup are deleted
+def restore(url, version, password, to="", verify=False, paths=None, delta=False, delete_extra=False,
+            checksum=False):
+    with UrlLock(url):
+        run_async(restore_locked(url, version, password, to, verify, paths, delta, delete_extra, checksum))
+
+
+# chains are prepared (index download, comparison, tome selection) at once, then every chain is extracted as soon
+# as its own tomes are downloaded, while downloads of other chains go on
+async def restore_locked(url, version, password, to, verify, paths, delta=False, delete_extra=False,
+                         checksum=False):
+    state, current_full_backup, base, v = await in_thread(load_version, url, version, password)
+    work_dir = full_local_dir(url) + "/restore"
+    chains = backup_chains(current_full_backup)
+    threads = config_value(state, "parallel_downloads")
+
+    # chain is downloaded and extracted in its own directory, shards of one version together restore all files
+    def chain_dir(chain):
+        return work_dir + "/" + chain_prefix(current_full_backup, chain)
+
+    # download index, returns [chain, tomes to download or None if delta restore has nothing to extract from chain,
+    # paths to extract or None for all, entries of version, target entries to remove before extraction]
+    def prepare(chain):
+        chain_base = full_remote_dir(url, chain["name"])
+        index = "a00000.zpaq." + chain["index_version"]
+        with metrics.phase("index_download"):
+            fetch_tome(url, chain_base, chain, index, chain_dir(chain) + "a00000.zpaq")
+
+        chain_paths = paths
+        entries = {}
+        conflicts = []
+        if delta:
+            with metrics.phase("compare"):
+                entries = index_entries(chain_dir(chain) + "a00000.zpaq", v, password)
+                if paths is not None:
+                    entries = {n: e for n, e in entries.items() if path_matches(n, paths)}
+                changed = content_changes(chain_dir(chain) + "a00000.zpaq", v, password, entries) \
+                    if checksum else None
+                chain_paths, conflicts = delta_entries(entries, to, changed)
+            if len(chain_paths) == 0:
+                return [chain, None, chain_paths, entries, conflicts]
+
+        tomes = [tome_name(i) for i in range(1, int(v) + 1)]
+        if chain_paths is not None:
+            with metrics.phase("select_tomes"):
+                needed = tomes_for_paths(chain_dir(chain) + "a00000.zpaq", v, password, chain_paths)
+            for i in range(1, int(v) + 1):
+                if i not in needed and can_skip_tome(chain, tome_name(i)):
+                    make_tome_placeholder(chain, tome_name(i), chain_dir(chain) + tome_name(i))
+                    tomes.remove(tome_name(i))
+        return [chain, tomes, chain_paths, entries, conflicts]
+
+    # invoke zpaq, shards hold different files and are extracted at once
+    # failure is reported and ignored, except for delta restore, which is expected to leave target complete
+    async def extract(chain, only):
+        zpaq_command = [get_script_dir() + "/zpaq", "extract", chain_dir(chain) + "a?????.zpaq", "-until", v,
+                        "-force"]
+        if verify:
+            zpaq_command += ["-test"]
+
+        if only is not None:
+            zpaq_command += ["-only"] + only
+
+        if to != "":
+            zpaq_command += ["-to", to]
+
+        if password != "":
+            zpaq_command += ["-key", password]
+
+        with tempfile.NamedTemporaryFile(prefix="river-c-") as f:
+            try:
+                await Proc(zpaq_command, "zpaq invocation failed").run_async(stdout, f)
+            except Exception:
+                f.seek(0)
+                sys.stderr.write(f.read().decode('utf-8'))
+                if delta:
+                    raise
+
+    # long -only lists are split between several runs to stay within command line limit
+    # target entries in the way of extraction are only removed once tomes of the chain are downloaded
+    async def download_and_extract(downloads, chain, tomes, chain_paths, conflicts, segment_threads):
+        with metrics.phase("download"):
+            await asyncio.gather(*[downloads.spawn(in_thread(fetch_tome, url, full_remote_dir(url, chain["name"]),
+                                                             chain, fname, chain_dir(chain) + fname,
+                                                             segment_threads))
+                                   for fname in tomes])
+        with metrics.phase("extract"):
+            remove_conflicts(conflicts)
+            if chain_paths is None:
+                await extract(chain, None)
+                return
+            chunk = []
+            for p in chain_paths:
+                chunk.append(p)
+                if sum(len(c) + 1 for c in chunk) >= extract_args_limit:
+                    await extract(chain, chunk)
+                    chunk = []
+            if len(chunk) > 0:
+                await extract(chain, chunk)
+
+    shutil.rmtree(work_dir, True)
+    try:
+        prepared = await run_all([in_thread(prepare, chain) for chain in chains], threads)
+        chain_tomes = [p for p in prepared if p[1] is not None]
+        all_entries = {}
+        for p in prepared:
+            all_entries.update(p[3])
+        check_disk_budget(url, work_dir, [[chain, tomes] for chain, tomes, _, _, _ in chain_tomes])
+
+        # download slots not taken by whole tomes go to segments of segmented ones
+        segment_threads = max(1, threads // max(1, sum(len(tomes) for _, tomes, _, _, _ in chain_tomes)))
+        async with TaskGroup(threads) as downloads, TaskGroup() as group:
+            for chain, tomes, chain_paths, _, conflicts in chain_tomes:
+                group.spawn(download_and_extract(downloads, chain, tomes, chain_paths, conflicts, segment_threads))
+
+        if delta and delete_extra:
+            # backup directories of sharded backup are not archived, only entries in them
+            if "shards" in current_full_backup:
+                roots = sorted(set(os.path.dirname(e) for shard in current_full_backup["shards"]
+                                   for e in shard.get("entries", [])))
+            else:
+                roots = [n.rstrip("/") for n in top_entries(all_entries) if n.endswith("/")]
+            with metrics.phase("delete_extra"):
+                await in_thread(delete_extra_files, all_entries, roots, to, paths)
+    finally:
+        shutil.rmtree(work_dir, True)
 
 
 def pipe():
@@ -463,7 +2993,8 @@ def pipe():
 # delete <url>
 # list <url>
 # backup <url> <dir(s) to backup>
-# restore <url> <version> [target directory]
+# backup-all <jobs file>
+# restore <url> <version> [target directory] [--path <pattern(s)>]
 
 
 example_config = """# This is river configuration file
@@ -485,9 +3016,43 @@ keep_incremental_backup_count: 30
 # When this limit is reached, oldest backup will be deleted
 keep_full_backup_count: 3
 
+# How many files to upload at once
+# Increase if single upload stream does not saturate the link
+parallel_uploads: 1
+
+# How many files to download at once on restore and verify
+parallel_downloads: 1
+
 # Encrypt backups if true
 # Encryption key must be passed to river via river_key environment variable
 use_encryption: false
+
+# Upload tomes in segments while they are being compressed
+# Makes backups faster and limits local disk usage to data not yet uploaded
+stream_upload: false
+
+# Upload tomes larger than this in segments of this size, in MB, 0 to upload them whole
+# Segments are uploaded and downloaded in parallel and failed upload only repeats its segment
+# With stream_upload, 0 means 64
+segment_size: 0
+
+# How many full backups in a row to build from previous full backup instead of compressing all files again
+# Such full backup starts as copy of previous one, made on remote side if driver supports it,
+# so only changed files are read and uploaded. Data of deleted files is only dropped by regular full backup
+synthetic_full_backups: 0
+
+# How many zpaq processes compress at once, each into its own archive chain
+# Top-level entries of backup directories are split between shards and stay in their shard,
+# new ones go to shard with least data. Takes effect from next full backup, synthetic full backups are not used
+shards: 1
+
+# zpaq compression method, 0 to 5 = faster to better, or auto
+# auto picks the method with shortest compression and upload time, by compression and upload throughput
+# measured by previous backups: light methods for fast links, heavy ones for slow links
+compression_method: 1
+
+# Threads of each zpaq process, 0 for all cores (split between shards)
+compression_threads: 0
 """
 
 
@@ -508,13 +3073,64 @@ def help():
     sys.stderr.write("list <url>                        Show remote backup configuration and available versions for "
                      "restore \n")
     sys.stderr.write("backup <url> <dirs>               Perform incremental backup on space-separated directories\n")
+    sys.stderr.write("backup-all <jobs file>            Perform backups listed in yaml jobs file in parallel, "
+                     "see example below\n")
+    sys.stderr.write("watch <url> <dirs>                Keep running, recording changes under directories, so "
+                     "backups of this url\n")
+    sys.stderr.write("                                  on this machine only pass changed paths to zpaq instead of "
+                     "scanning all files.\n")
     sys.stderr.write("restore <url> <version> [target]  Restore backup at specified version. Files will be restored "
                      "under target\n")
     sys.stderr.write("                                  directory if provided, otherwise files will be restored inplace.\n")
+    sys.stderr.write("  [--path <patterns>]             Restore only files matching patterns (* and ? are wildcards), "
+                     "downloading\n")
+    sys.stderr.write("                                  only data they need.\n")
+    sys.stderr.write("  [--delta]                       Only restore files missing in target or differing from "
+                     "backup by size,\n")
+    sys.stderr.write("                                  mtime or permissions, downloading only data they need.\n")
+    sys.stderr.write("  [--checksum]                    With --delta, compare file contents instead of sizes and "
+                     "mtimes.\n")
+    sys.stderr.write("                                  Only for restore in place.\n")
+    sys.stderr.write("  [--delete]                      With --delta, delete files of restored directories which "
+                     "are not in backup.\n")
     sys.stderr.write("verify <url> <version>            Verify backup correctness at specified version.\n")
+    sys.stderr.write("  [--quick]                       Only check remote files against sizes and hashes recorded on "
+                     "upload,\n")
+    sys.stderr.write("                                  without downloading them. Requires driver stat operation.\n")
+    sys.stderr.write("  [--sample N]                    Only download index and N random tomes and check their "
+                     "hashes.\n")
     sys.stderr.write("\n")
     sys.stderr.write("If backup encryption is used, encryption password must be provided in river_key environment "
                      "variable.\n")
+    sys.stderr.write("Local disk used by restore can be limited by river_restore_disk_budget environment variable, "
+                     "in MB.\n")
+    sys.stderr.write("Downloaded tomes are cached locally if river_cache_size environment variable is set, in MB.\n")
+    sys.stderr.write("  Cache directory can be set by river_cache_dir.\n")
+    sys.stderr.write("\n")
+    sys.stderr.write("Jobs file example:\n")
+    sys.stderr.write("  concurrency: 4          # backups to run at once\n")
+    sys.stderr.write("  driver_concurrency:     # backups to run at once per driver\n")
+    sys.stderr.write("    ssh: 2\n")
+    sys.stderr.write("  jobs:\n")
+    sys.stderr.write("    - url: ssh:bkp@host.com:/backups/test-backup\n")
+    sys.stderr.write("      dirs: [/data/my-files]\n")
+    sys.stderr.write("      key_env: river_key    # variable with encryption password, if encryption is used\n")
+    sys.stderr.write("\n")
+    sys.stderr.write("ssh driver connections are shared per host for the whole command, set river_ssh_multiplex=false "
+                     "to disable.\n")
+    sys.stderr.write("Uploads and downloads are limited by river_bandwidth_limit in MB/s, either single number or "
+                     "time-of-day ranges,\n")
+    sys.stderr.write("  e.g. 08:00-20:00=2,20:00-08:00=50. Driver scripts get the limit in river_rate_limit and need "
+                     "pv for it.\n")
+    sys.stderr.write("  Failed transfers are retried river_transfer_retries times (default 2).\n")
+    sys.stderr.write("  With river_adaptive_concurrency=true, transfers run at once are tuned by throughput and errors, "
+                     "up to\n")
+    sys.stderr.write("  parallel_uploads and parallel_downloads.\n")
+    sys.stderr.write("Per-phase timings, driver transfers and process counts of the command are written as json to "
+                     "river_metrics_json file\n")
+    sys.stderr.write("  and in Prometheus text format to river_metrics_prom file, if these variables are set.\n")
+    sys.stderr.write("Drivers are looked up in colon-separated river_driver_path directories first, then next to "
+                     "river.py.\n")
 
 
 def help_on_error(result):
@@ -552,6 +3168,7 @@ def parse_command(argv):
         return {"error": "Too many arguments for command " + argv[1]}
 
     return {
+        "name": argv[1],
         "cmd": cmd[0],
         "params": argv[2:]
     }
@@ -571,6 +3188,24 @@ def psw():
         return ""
 
 
+# optional config keys: name -> [type, default value, minimal value for numbers]
+# backups created before a key was introduced use its default value
+optional_config = {
+    "parallel_uploads": [int, 1, 1],
+    "parallel_downloads": [int, 1, 1],
+    "stream_upload": [bool, False, None],
+    "segment_size": [int, 0, 0],
+    "synthetic_full_backups": [int, 0, 0],
+    "shards": [int, 1, 1],
+    "compression_method": [object, 1, None],  # 0 to 5 or auto, checked by update_config
+    "compression_threads": [int, 0, 0],
+}
+
+
+def config_value(state, name):
+    return state.get(name, optional_config[name][1])
+
+
 def update_config(state, cfg):
     def check_list(name):
         for e in cfg[name]:
@@ -579,29 +3214,44 @@ def update_config(state, cfg):
 
     def check(name, tpe):
         if not isinstance(cfg[name], tpe):
-            fail(name + " must be " + tpe)
+            fail(name + " must be " + tpe.__name__)
 
     check_list("exclude")
     check_list("include_only")
     check("keep_incremental_backup_count", int)
     check("keep_full_backup_count", int)
     check("use_encryption", bool)
+    for name in optional_config:
+        if name in cfg:
+            check(name, optional_config[name][0])
+            if optional_config[name][2] is not None and cfg[name] < optional_config[name][2]:
+                fail(name + " must be at least " + str(optional_config[name][2]))
+
+    if "compression_method" in cfg and cfg["compression_method"] != "auto" and \
+            (isinstance(cfg["compression_method"], bool) or cfg["compression_method"] not in compression_methods):
+        fail("compression_method must be 0 to 5 or auto")
 
     state["local"]["exclude"] = cfg["exclude"]
     state["local"]["include_only"] = cfg["include_only"]
     state["keep_incremental_backup_count"] = cfg["keep_incremental_backup_count"]
     state["keep_full_backup_count"] = cfg["keep_full_backup_count"]
     state["use_encryption"] = cfg["use_encryption"]
+    for name in optional_config:
+        if name in cfg:
+            state[name] = cfg[name]
 
 
 def extract_config(state):
-    return {
+    cfg = {
         "exclude": state["local"]["exclude"],
         "include_only": state["local"]["include_only"],
         "keep_incremental_backup_count": state["keep_incremental_backup_count"],
         "keep_full_backup_count": state["keep_full_backup_count"],
         "use_encryption": state["use_encryption"]
     }
+    for name in optional_config:
+        cfg[name] = config_value(state, name)
+    return cfg
 
 
 def cmd_create_config(args):
@@ -643,7 +3293,7 @@ def cmd_create(args):
     update_config(state, cfg)
 
     try:
-        download(url + "/index.yaml", "/dev/null").pipe(Proc.sink("/dev/null")).run(stdout, stdout)
+        download(url + "/index.yaml", "/dev/null", probe=True).run(stdout, stdout)
         fail("Backup already exists at url " + args[0])
     except Exception as e:
         pass
@@ -711,7 +3361,120 @@ def cmd_backup(args):
     perform_backup(url, dirs, psw())
 
 
+def cmd_watch(args):
+    url = normalize_url(args[0])
+    try:
+        watch_changes(url, args[1:], threading.Event())
+    except KeyboardInterrupt:
+        pass
+    except IOError as e:
+        fail(str(e))
+
+
+# backup jobs file format:
+#
+# concurrency: 4          how many backups to run at once, default 1
+# driver_concurrency:     how many backups to run at once per driver, default is no limit
+#   ssh: 2
+# jobs:
+#   - url: ssh:bkp@host.com:/backups/test-backup
+#     dirs: [/data/my-files]
+#     key_env: river_key  environment variable with encryption password, default is no encryption
+def load_jobs(fname):
+    if not os.path.exists(fname):
+        fail("Jobs file not found: " + fname)
+    with open(fname) as f:
+        cfg = yaml.safe_load(f.read())
+
+    if not isinstance(cfg, dict) or not isinstance(cfg.get("jobs"), list):
+        fail("Jobs file must contain jobs list")
+    if not isinstance(cfg.get("concurrency", 1), int) or cfg.get("concurrency", 1) < 1:
+        fail("concurrency must be positive number")
+    driver_concurrency = cfg.get("driver_concurrency", {})
+    if not isinstance(driver_concurrency, dict) or \
+            not all(isinstance(n, int) and n >= 1 for n in driver_concurrency.values()):
+        fail("driver_concurrency must map driver names to positive numbers")
+    for job in cfg["jobs"]:
+        if not isinstance(job, dict) or not isinstance(job.get("url"), str):
+            fail("every job must have url")
+        dirs = job.get("dirs")
+        if not isinstance(dirs, list) or len(dirs) == 0 or not all(isinstance(d, str) for d in dirs):
+            fail("job " + job["url"] + " must have dirs list")
+        job["url"] = normalize_url(job["url"])
+    return cfg
+
+
+# run backup jobs in parallel, within global and per-driver limits
+# returns list of job results: [url, error or None, seconds]
+def perform_backups(cfg):
+    concurrency = cfg.get("concurrency", 1)
+    driver_concurrency = cfg.get("driver_concurrency", {})
+    pending = list(cfg["jobs"])
+    results = []
+    running = {}
+    per_driver = {}
+
+    def run_job(job):
+        start = time.time()
+        try:
+            password = os.environ.get(job["key_env"], "") if "key_env" in job else ""
+            perform_backup(job["url"], job["dirs"], password)
+            return [job["url"], None, time.time() - start]
+        except SystemExit:
+            # fail() already printed the reason
+            return [job["url"], "failed", time.time() - start]
+        except Exception as e:
+            return [job["url"], str(e) or type(e).__name__, time.time() - start]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for job in list(pending):
+                if len(running) >= concurrency:
+                    break
+                driver = parse_url(job["url"]).protocol
+                if per_driver.get(driver, 0) >= driver_concurrency.get(driver, concurrency):
+                    continue
+                per_driver[driver] = per_driver.get(driver, 0) + 1
+                running[executor.submit(run_job, job)] = driver
+                pending.remove(job)
+
+            done, _ = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                per_driver[running.pop(fut)] -= 1
+                results.append(fut.result())
+
+    return results
+
+
+def cmd_backup_all(args):
+    cfg = load_jobs(args[0])
+    results = perform_backups(cfg)
+
+    failed = 0
+    print("Status\tSeconds\tUrl")
+    for url, error, seconds in results:
+        print(("OK" if error is None else "FAILED") + "\t" + str(int(seconds)) + "\t" + url)
+        if error is not None:
+            failed += 1
+            sys.stderr.write(url + ": " + error + "\n")
+    if failed > 0:
+        fail(str(failed) + " of " + str(len(results)) + " backup jobs failed")
+
+
 def cmd_restore(args):
+    paths = None
+    if "--path" in args:
+        paths = args[args.index("--path") + 1:]
+        args = args[:args.index("--path")]
+        if len(paths) == 0:
+            return {"error": "--path requires at least one pattern"}
+    flags = [a for a in args if a in ["--delta", "--delete", "--checksum"]]
+    args = [a for a in args if a not in flags]
+    if ("--delete" in flags or "--checksum" in flags) and "--delta" not in flags:
+        return {"error": "--delete and --checksum require --delta"}
+    if len(args) < 2 or len(args) > 3:
+        return {"error": "Wrong number of arguments for command restore"}
+
     url = normalize_url(args[0])
     version = args[1]
     if len(args) < 3:
@@ -719,13 +3482,40 @@ def cmd_restore(args):
     else:
         target = args[2]
 
-    restore(url, version, psw(), target)
+    if "--checksum" in flags and target != "":
+        fail("--checksum only works for restore in place, zpaq compares files under their archived names")
+    restore(url, version, psw(), target, paths=paths, delta="--delta" in flags, delete_extra="--delete" in flags,
+            checksum="--checksum" in flags)
 
 
 def cmd_verify(args):
+    quick = "--quick" in args
+    args = [a for a in args if a != "--quick"]
+    sample = None
+    if "--sample" in args:
+        i = args.index("--sample")
+        if i + 1 >= len(args) or not args[i + 1].isdigit():
+            return {"error": "--sample requires number of tomes"}
+        sample = int(args[i + 1])
+        args = args[:i] + args[i + 2:]
+    if len(args) != 2:
+        return {"error": "Wrong number of arguments for command verify"}
+
     url = normalize_url(args[0])
     version = args[1]
-    restore(url, version, psw(), verify=True)
+    if not quick and sample is None:
+        restore(url, version, psw(), verify=True)
+        return
+
+    problems = []
+    if quick:
+        problems += verify_quick(url, version, psw())
+    if sample is not None:
+        problems += verify_sample(url, version, psw(), sample)
+    for p in problems:
+        sys.stderr.write(p + "\n")
+    if len(problems) > 0:
+        fail("Verification failed")
 
 
 commands = {
@@ -735,8 +3525,10 @@ commands = {
     "delete": [cmd_delete, 1, 1],
     "list": [cmd_list, 1, 1],
     "backup": [cmd_backup, 2, None],
-    "restore": [cmd_restore, 2, 3],
-    "verify": [cmd_verify, 2, 2]
+    "backup-all": [cmd_backup_all, 1, 1],
+    "watch": [cmd_watch, 2, None],
+    "restore": [cmd_restore, 2, None],
+    "verify": [cmd_verify, 2, 5]
 }
 
 
@@ -744,7 +3536,12 @@ def main():
     command = parse_command(sys.argv)
     help_on_error(command)
 
-    r = command["cmd"](command["params"])
+    success = False
+    try:
+        r = command["cmd"](command["params"])
+        success = r is None or "error" not in r
+    finally:
+        write_metrics(command["name"], command["params"][0] if len(command["params"]) > 0 else "", success)
     help_on_error(r)
 
 
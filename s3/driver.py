@@ -0,0 +1,339 @@
+# in-process S3 driver for river
+#
+# remote paths are s3://<bucket>/<key>, same as for aws CLI based scripts next to this module
+# requests are signed with AWS signature version 4 and sent over keep-alive connections shared by all threads
+# files larger than part_size are uploaded by multipart upload and downloaded by ranged requests,
+# up to `threads` parts of one file at once
+#
+# credentials and region are taken from environment only, without ~/.aws files, profiles or instance roles,
+# so the driver is used only when they are set there, otherwise river falls back to aws CLI scripts
+#
+# environment:
+#   AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_SESSION_TOKEN  credentials
+#   AWS_REGION or AWS_DEFAULT_REGION                               region, may be omitted if river_s3_endpoint is set
+#   river_s3_endpoint     S3-compatible service url, e.g. http://minio:9000, path-style requests are used then
+#   river_s3_part_size    part size in MB, default 16
+#   river_s3_threads      parts of one file transferred at once, default 4
+import concurrent.futures
+import datetime
+import hashlib
+import hmac
+import http.client
+import os
+import threading
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+part_size = int(os.getenv("river_s3_part_size", "16")) * 1024 * 1024
+threads = int(os.getenv("river_s3_threads", "4"))
+copy_limit = 5 * 1024 * 1024 * 1024  # largest object S3 copies in single request
+copy_part_size = 512 * 1024 * 1024
+empty_sha256 = hashlib.sha256(b"").hexdigest()
+
+
+class S3Error(IOError):
+    pass
+
+
+# replaced by river, called for every chunk of bytes sent or received, blocks to keep bandwidth limit
+def throttle(size):
+    pass
+
+
+# body sent by chunks, so bytes are throttled while they are sent
+def throttled(body, chunk=64 * 1024):
+    for i in range(0, len(body), chunk):
+        throttle(min(chunk, len(body) - i))
+        yield body[i:i + chunk]
+
+
+def region():
+    return os.getenv("AWS_REGION", os.getenv("AWS_DEFAULT_REGION", "us-east-1"))
+
+
+# driver can sign requests without aws CLI configuration
+def available():
+    return os.getenv("AWS_ACCESS_KEY_ID", "") != "" and os.getenv("AWS_SECRET_ACCESS_KEY", "") != "" and \
+        (os.getenv("AWS_REGION", os.getenv("AWS_DEFAULT_REGION", "")) != "" or os.getenv("river_s3_endpoint", "") != "")
+
+
+# idle keep-alive connections per scheme and host
+class ConnectionPool:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, scheme, host):
+        with self.lock:
+            conns = self.idle.get((scheme, host), [])
+            if len(conns) > 0:
+                return conns.pop()
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=300)
+        return http.client.HTTPConnection(host, timeout=300)
+
+    def put(self, scheme, host, conn):
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(conn)
+
+
+pool = ConnectionPool()
+
+
+# s3://bucket/key -> [bucket, key]
+def parse(path):
+    if path.startswith("s3://"):
+        path = path[5:]
+    bucket, _, key = path.lstrip("/").partition("/")
+    if bucket == "":
+        raise S3Error("no bucket in " + path)
+    return bucket, key
+
+
+# [scheme, host, request path]
+def address(bucket, key):
+    endpoint = os.getenv("river_s3_endpoint", "")
+    if endpoint != "":
+        u = urllib.parse.urlparse(endpoint)
+        return u.scheme, u.netloc, "/" + bucket + ("/" + key if key != "" else "")
+    if "." in bucket:  # virtual host name would not match wildcard TLS certificate
+        return "https", "s3." + region() + ".amazonaws.com", "/" + bucket + "/" + key
+    return "https", bucket + ".s3." + region() + ".amazonaws.com", "/" + key
+
+
+def quote(s, safe="-_.~"):
+    return urllib.parse.quote(s, safe=safe)
+
+
+def hmac_sha256(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+# headers with AWS signature version 4 authorization added
+def sign(method, host, path, query, headers, payload_sha256, now, access_key, secret_key, token=None):
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date = now.strftime("%Y%m%d")
+    headers = dict(headers)
+    headers["host"] = host
+    headers["x-amz-date"] = amz_date
+    headers["x-amz-content-sha256"] = payload_sha256
+    if token:
+        headers["x-amz-security-token"] = token
+
+    lower = {k.lower(): " ".join(str(v).split()) for k, v in headers.items()}
+    names = sorted(lower)
+    signed_headers = ";".join(names)
+    canonical_query = "&".join(quote(k) + "=" + quote(v) for k, v in sorted(query.items()))
+    canonical_request = "\n".join([method, quote(path, "/-_.~"), canonical_query,
+                                   "".join(k + ":" + lower[k] + "\n" for k in names), signed_headers, payload_sha256])
+    scope = date + "/" + region() + "/s3/aws4_request"
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()])
+
+    key = hmac_sha256(("AWS4" + secret_key).encode("utf-8"), date)
+    for part in [region(), "s3", "aws4_request"]:
+        key = hmac_sha256(key, part)
+    signature = hmac.new(key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    del headers["host"]
+    headers["Authorization"] = "AWS4-HMAC-SHA256 Credential=" + access_key + "/" + scope + \
+                               ", SignedHeaders=" + signed_headers + ", Signature=" + signature
+    return headers
+
+
+# sends request, returns [status, lowercase headers, body]
+# if out is set, successful response body is written to it instead
+def request(method, bucket, key, query=None, headers=None, body=b"", expect=(200,), out=None):
+    query = query or {}
+    scheme, host, path = address(bucket, key)
+    payload_sha256 = hashlib.sha256(body).hexdigest() if body else empty_sha256
+    headers = sign(method, host, path, query, headers or {}, payload_sha256,
+                   datetime.datetime.now(datetime.timezone.utc), os.getenv("AWS_ACCESS_KEY_ID", ""),
+                   os.getenv("AWS_SECRET_ACCESS_KEY", ""), os.getenv("AWS_SESSION_TOKEN"))
+    if body:
+        headers["Content-Length"] = str(len(body))
+    target = quote(path, "/-_.~")
+    if query:
+        target += "?" + "&".join(quote(k) + "=" + quote(v) for k, v in query.items())
+
+    for attempt in range(2):  # pooled connection may have been closed by server, then retry on a new one
+        conn = pool.get(scheme, host)
+        written = 0
+        try:
+            conn.request(method, target, body=throttled(body) if body else body, headers=headers)
+            resp = conn.getresponse()
+            if resp.status in expect and out is not None and method != "HEAD":
+                while True:
+                    buf = resp.read(1024 * 1024)
+                    if len(buf) == 0:
+                        break
+                    out.write(buf)
+                    written += len(buf)
+                    throttle(len(buf))
+                length = resp.getheader("content-length")
+                if length is not None and written != int(length):  # http.client returns short body on eof
+                    raise http.client.IncompleteRead(b"", int(length) - written)
+                data = b""
+            else:
+                data = resp.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if attempt == 1 or written > 0:  # retry would write body again after part of it
+                raise
+            continue
+
+        if resp.will_close:
+            conn.close()
+        else:
+            pool.put(scheme, host, conn)
+        if resp.status not in expect:
+            raise S3Error(method + " s3://" + bucket + "/" + key + ": " + str(resp.status) + " " + resp.reason + " " +
+                          data[:500].decode("utf-8", "replace"))
+        return resp.status, {k.lower(): v for k, v in resp.getheaders()}, data
+
+
+def file_sha256(fname):
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        while True:
+            buf = f.read(1024 * 1024)
+            if len(buf) == 0:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+def read_part(fname, offset):
+    with open(fname, "rb") as f:
+        f.seek(offset)
+        return f.read(part_size)
+
+
+def xml_text(data, tag):
+    return [e.text or "" for e in ElementTree.fromstring(data).iter() if e.tag.split("}")[-1] == tag]
+
+
+def upload(src, dst):
+    bucket, key = parse(dst)
+    size = os.path.getsize(src)
+    meta = {"x-amz-meta-sha256": file_sha256(src)}  # lets stat report sha256 without download
+    if size <= part_size:
+        request("PUT", bucket, key, headers=meta, body=read_part(src, 0))
+        return
+
+    upload_id = xml_text(request("POST", bucket, key, {"uploads": ""}, meta)[2], "UploadId")[0]
+    try:
+        def put_part(n):
+            return request("PUT", bucket, key, {"partNumber": str(n + 1), "uploadId": upload_id},
+                           body=read_part(src, n * part_size))[1]["etag"]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            etags = list(executor.map(put_part, range((size + part_size - 1) // part_size)))
+
+        complete_multipart_upload(bucket, key, upload_id, etags, dst)
+    except Exception:
+        abort_multipart_upload(bucket, key, upload_id)
+        raise
+
+
+def complete_multipart_upload(bucket, key, upload_id, etags, dst):
+    complete = "<CompleteMultipartUpload>" + "".join(
+        "<Part><PartNumber>" + str(n + 1) + "</PartNumber><ETag>" + etag + "</ETag></Part>"
+        for n, etag in enumerate(etags)) + "</CompleteMultipartUpload>"
+    data = request("POST", bucket, key, {"uploadId": upload_id}, body=complete.encode("utf-8"))[2]
+    if len(xml_text(data, "Code")) > 0:  # S3 may fail with 200 here
+        raise S3Error("multipart upload of " + dst + " failed: " + data.decode("utf-8", "replace"))
+
+
+def abort_multipart_upload(bucket, key, upload_id):
+    try:
+        request("DELETE", bucket, key, {"uploadId": upload_id}, expect=(200, 204))
+    except IOError:
+        pass
+
+
+def download(src, dst):
+    bucket, key = parse(src)
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    size = int(request("HEAD", bucket, key)[1]["content-length"])
+    if size <= part_size:
+        with open(dst, "wb") as f:
+            request("GET", bucket, key, out=f)
+        return
+
+    with open(dst, "wb") as f:
+        f.truncate(size)
+
+    def get_range(offset):
+        with open(dst, "r+b") as f:
+            f.seek(offset)
+            request("GET", bucket, key, headers={"Range": "bytes=" + str(offset) + "-" +
+                                                 str(min(size, offset + part_size) - 1)}, expect=(206,), out=f)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(get_range, range(0, size, part_size)))
+
+
+def list_keys(bucket, prefix):
+    keys = []
+    token = None
+    while True:
+        query = {"list-type": "2", "prefix": prefix}
+        if token is not None:
+            query["continuation-token"] = token
+        data = request("GET", bucket, "", query)[2]
+        keys += xml_text(data, "Key")
+        truncated = xml_text(data, "IsTruncated")
+        tokens = xml_text(data, "NextContinuationToken")
+        if len(truncated) == 0 or truncated[0] != "true" or len(tokens) == 0:
+            return keys
+        token = tokens[0]
+
+
+# deletes file or everything under directory, like `aws s3 rm --recursive`
+def delete(path):
+    bucket, key = parse(path)
+    if key.strip("/") in ["", "."]:
+        return
+    keys = set(list_keys(bucket, key.rstrip("/") + "/"))
+    keys.add(key)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda k: request("DELETE", bucket, k, expect=(200, 204)), sorted(keys)))
+
+
+# server-side copy, by parts for objects larger than 5GB
+def copy(src, dst):
+    src_bucket, src_key = parse(src)
+    bucket, key = parse(dst)
+    source = "/" + src_bucket + "/" + quote(src_key, "/-_.~")
+    headers = request("HEAD", src_bucket, src_key)[1]
+    size = int(headers["content-length"])
+    if size <= copy_limit:
+        data = request("PUT", bucket, key, headers={"x-amz-copy-source": source})[2]
+        if len(xml_text(data, "Code")) > 0:  # S3 may fail with 200 here
+            raise S3Error("copy of " + src + " failed: " + data.decode("utf-8", "replace"))
+        return
+
+    meta = {k: v for k, v in headers.items() if k.startswith("x-amz-meta-")}
+    upload_id = xml_text(request("POST", bucket, key, {"uploads": ""}, meta)[2], "UploadId")[0]
+    try:
+        def copy_part(n):
+            end = min(size, (n + 1) * copy_part_size) - 1
+            data = request("PUT", bucket, key, {"partNumber": str(n + 1), "uploadId": upload_id},
+                           {"x-amz-copy-source": source,
+                            "x-amz-copy-source-range": "bytes=" + str(n * copy_part_size) + "-" + str(end)})[2]
+            return xml_text(data, "ETag")[0]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            etags = list(executor.map(copy_part, range((size + copy_part_size - 1) // copy_part_size)))
+        complete_multipart_upload(bucket, key, upload_id, etags, dst)
+    except Exception:
+        abort_multipart_upload(bucket, key, upload_id)
+        raise
+
+
+def stat(path):
+    bucket, key = parse(path)
+    headers = request("HEAD", bucket, key)[1]
+    return [int(headers["content-length"]), headers.get("x-amz-meta-sha256")]